@@ -0,0 +1,172 @@
+import os
+import sys
+import numpy as np
+import pytest
+import scipy.integrate
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+import CustomModel
+import odeSolvers
+
+def make_model(modelClass=CustomModel.EinarPersistorModelType3L, **kwargs):
+    model = modelClass(**kwargs)
+    d = model.paramDic
+    model.initialStateList = [d['n'] * (1 - d['fracRes']), d['n'] * d['fracRes']]
+    return model
+
+def test_simulate_batch_expm():
+    schedule = [[0, 20, 1], [20, 40, 0]]
+    model = make_model()
+    initialStateMat = [model.initialStateList, [500, 100]]
+    model.SimulateBatch(schedule, initialStateMat, method='expm', dt=0.5)
+    assert model.successB
+    for trajectoryId, initialStateVec in enumerate(initialStateMat):
+        model.Simulate(schedule, initialStateVec=initialStateVec, method='expm', dt=0.5)
+        batchDf = model.batchResultsDf[model.batchResultsDf['TrajectoryId'] == trajectoryId]
+        np.testing.assert_allclose(batchDf[['S', 'R']].to_numpy(), model.resultsDf[['S', 'R']].to_numpy(), rtol=1e-12)
+
+# The sweep carries the state over between intervals at the same time points as Simulate_AT1,
+# including for a dt with which these overshoot the end of the interval (1e-3, 0.1)
+@pytest.mark.skipif(not odeSolvers.NUMBA_AVAILABLE, reason="Simulate_AT1 sweeps require Numba")
+@pytest.mark.parametrize("dt", [1e-3, 0.1, 0.25])
+def test_sweep_at1_matches_simulate_at1(dt):
+    model = make_model()
+    model.Simulate_AT1(D0=1, t_end=50, solver_kws={'dt': dt, 'method': 'DOP853'})
+    resultsDf = model.resultsDf
+    model.SimulateSweep_AT1([{}, {'lambda0': 0.05}], D0=1, t_end=50, solver_kws={'dt': dt})
+    assert model.successB
+    sweepDf = model.sweepResultsDf[model.sweepResultsDf['ParamSetId'] == 0]
+    atDf = resultsDf.drop_duplicates('Time').set_index('Time').loc[sweepDf['Time']]  # The first row at each time is that of the interval ending there
+    np.testing.assert_allclose(sweepDf['DrugConcentration'].to_numpy(), atDf['DrugConcentration'].to_numpy())
+    np.testing.assert_allclose(sweepDf[['S', 'R']].to_numpy(), atDf[['S', 'R']].to_numpy(), rtol=1e-10)
+
+def test_results_precision():
+    schedule = [[0, 10, 1], [10, 20, 0]]
+    model = make_model()
+    model.Simulate(schedule, dt=0.5)
+    assert (model.resultsDf.dtypes == np.float64).all()
+    model = make_model(store_precision='float32')
+    model.Simulate(schedule, dt=0.5)
+    dtypes = model.resultsDf.dtypes
+    assert (dtypes[['S', 'R', 'TumourSize']] == np.float32).all()
+    assert (dtypes[['Time', 'DrugConcentration']] == np.float64).all()
+
+@pytest.mark.skipif(not odeSolvers.NUMBA_AVAILABLE, reason="Simulate_AT1 sweeps require Numba")
+def test_sweep_at1_checks_initial_states():
+    model = make_model()
+    with pytest.raises(ValueError, match="initialStateMat"):
+        model.SimulateSweep_AT1([{}, {}, {}], initialStateMat=[model.initialStateList], D0=1, t_end=10)
+    with pytest.raises(ValueError, match="initialStateMat"):
+        model.SimulateSweep_AT1([{}], initialStateMat=[model.initialStateList] * 4, D0=1, t_end=10)
+    with pytest.raises(ValueError, match="initialStateMat"):
+        model.SimulateSweep_AT1([{}], initialStateMat=[[1000.]], D0=1, t_end=10)
+
+# With a dt for which the time points of each interval overshoot its end (1e-3), no interval
+# continues the solution of the last, so the adaptive therapy loop shouldn't solve ahead
+@pytest.mark.parametrize("dt", [1e-3, 0.25])
+def test_dose_regimes_solve_little_in_vain(dt, monkeypatch):
+    solve_ivp = scipy.integrate.solve_ivp
+    tSolvedList = []
+    def counting_solve_ivp(*args, **kwargs):
+        tSolvedList.append(kwargs['t_span'][1] - kwargs['t_span'][0])
+        return solve_ivp(*args, **kwargs)
+    monkeypatch.setattr(scipy.integrate, 'solve_ivp', counting_solve_ivp)
+    model = make_model(useNumbaB=False)
+    model.Simulate_AT1(D0=1, t_end=100, solver_kws={'dt': dt, 'method': 'DOP853'})
+    assert model.successB
+    assert sum(tSolvedList) < 1.5 * 101  # Rather than 20 times as much, as when the lookahead kept growing
+    monkeypatch.undo()
+    referenceModel = make_model(method='expm')
+    referenceModel.Simulate_AT1(D0=1, t_end=100, solver_kws={'dt': dt})
+    np.testing.assert_allclose(model.resultsDf[['S', 'R']].to_numpy(), referenceModel.resultsDf[['S', 'R']].to_numpy(), rtol=1e-4)
+
+def test_stiffness_switch_is_limited_to_the_call():
+    schedule = [[0, 10, 1], [10, 20, 0]]
+    model = make_model(method='DOP853')
+    model.Simulate(schedule, dt=0.5, stiffSwitchThreshold=1e-9)
+    assert model.successB
+    assert 't_events' in model.solObj  # The last interval was solved by solve_ivp, with LSODA
+    assert model.solverMethod == 'DOP853'
+    model.Simulate_AT1(D0=1, t_end=10, solver_kws={'dt': 0.5})
+    assert model.solverMethod == 'DOP853'
+    model.Simulate(schedule, dt=0.5, stiffSwitchThreshold=None)
+    assert model.successB and model.solverMethod == 'DOP853'
+    if odeSolvers.NUMBA_AVAILABLE:
+        assert 't_events' not in model.solObj  # Back on the compiled DOP853 solver
+
+# The storage precision of a batch mustn't change its dynamics
+@pytest.mark.parametrize("method", ['RK45', 'DOP853'])
+def test_simulate_batch_precision(method):
+    schedule = [[t, t + 1, t % 2] for t in range(50)]
+    model = make_model()
+    initialStateMat = [model.initialStateList, [500, 100]]
+    model.SimulateBatch(schedule, initialStateMat, method=method, dt=0.5)
+    doubleDf = model.batchResultsDf
+    model.SimulateBatch(schedule, initialStateMat, dtype=np.float32, method=method, dt=0.5)
+    assert (model.batchResultsDf[['S', 'R']].dtypes == np.float32).all()
+    np.testing.assert_array_equal(model.batchResultsDf[['S', 'R']].to_numpy(), doubleDf[['S', 'R']].to_numpy(dtype=np.float32))
+
+# At each passage, the cells are reseeded at the seeding density, split by the resistant fraction
+# at the end of the previous cycle. The reseeded state replaces the last row of that cycle.
+@pytest.mark.parametrize("pKillB", [False, True])
+def test_long_term_assay_reseeding(pKillB):
+    schedule = [[0, 5, 1], [5, 10, 0], [10, 15, 1]]
+    seedingDensity, passagingLoss = 1e4, 0.8
+    model = make_model()
+    if pKillB:
+        model.Simulate_LongTermAssay_PKill(schedule, seeding_density=seedingDensity, passaging_loss=passagingLoss,
+                                           solver_kws={'dt': 0.5})
+    else:
+        model.Simulate_LongTermAssay(schedule, seeding_density=seedingDensity, solver_kws={'dt': 0.5})
+    assert model.successB
+    resultsDf = model.resultsDf
+    referenceModel = make_model()
+    for cycleId, cycle in enumerate(schedule[:-1]):
+        if cycleId > 0:
+            referenceModel.Simulate([cycle], initialStateVec=seededStateVec, dt=0.5)
+        else:
+            referenceModel.Simulate([cycle], dt=0.5)
+        S, R = referenceModel.resultsDf[['S', 'R']].iloc[-1]
+        seededStateVec = [seedingDensity * S / (S + R), seedingDensity * R / (S + R)]
+        if pKillB and cycle[2] > 0:
+            seededStateVec[0] *= 1 - passagingLoss
+        passageRow = resultsDf[resultsDf['Time'] == cycle[1]].iloc[0]  # Followed by the start of the next cycle, if the dose changes
+        assert passageRow['DrugConcentration'] == cycle[2]
+        np.testing.assert_allclose(passageRow[['S', 'R']].to_numpy(dtype=float), seededStateVec, rtol=1e-12)
+        np.testing.assert_allclose(passageRow['TumourSize'], sum(seededStateVec), rtol=1e-12)
+
+def test_simulate_initial_state_replaces_last_row():
+    model = make_model()
+    model.Simulate([[0, 5, 1]], dt=0.5)
+    nRows = len(model.resultsDf)
+    model.Simulate([[5, 10, 1]], initialStateVec=[100., 50.], dt=0.5)
+    resultsDf = model.resultsDf
+    assert len(resultsDf) == nRows + 10  # The first time point of the continuation isn't repeated
+    np.testing.assert_array_equal(resultsDf[['Time', 'DrugConcentration', 'S', 'R', 'TumourSize']].iloc[nRows - 1],
+                                  [5., 1., 100., 50., 150.])
+    np.testing.assert_array_equal(resultsDf['Time'].iloc[nRows:], 5.5 + 0.5 * np.arange(10))
+
+# The compiled solvers reproduce scipy's RK45 and DOP853 step for step over a single interval.
+# Over several intervals they carry their step size over, so only agree to the solver tolerance.
+@pytest.mark.skipif(not odeSolvers.NUMBA_AVAILABLE, reason="The compiled solvers require Numba")
+@pytest.mark.parametrize("method", ['RK45', 'DOP853'])
+@pytest.mark.parametrize("max_step", [np.inf, 0.5])
+def test_compiled_solvers_match_scipy(method, max_step):
+    for schedule, rtol in [([[0, 50, 0.5]], 1e-13), ([[t, t + 5, t % 2] for t in range(0, 50, 5)], 1e-5)]:
+        resultsList = []
+        for useNumbaB in (True, False):
+            model = make_model(method=method, max_step=max_step, useNumbaB=useNumbaB)
+            model.Simulate(schedule, dt=0.1)
+            assert model.successB
+            resultsList.append(model.resultsDf[['S', 'R']].to_numpy())
+        np.testing.assert_allclose(resultsList[0], resultsList[1], rtol=rtol)
+
+@pytest.mark.parametrize("method", ['RK45', 'DOP853', 'LSODA'])
+def test_solvers_match_expm(method):
+    schedule = [[t, t + 5, t % 2] for t in range(0, 50, 5)]
+    model = make_model(method='expm')
+    model.Simulate(schedule, dt=0.1)
+    exactMat = model.resultsDf[['S', 'R']].to_numpy()
+    model = make_model(method=method, relErr=1e-8, absErr=1e-10)
+    model.Simulate(schedule, dt=0.1)
+    assert model.successB
+    np.testing.assert_allclose(model.resultsDf[['S', 'R']].to_numpy(), exactMat, rtol=1e-6)
@@ -0,0 +1,95 @@
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from odeModelClass import ODEModel
+
+# Minimal model written against the plain ODEModel interface: exponential growth, with the
+# parameters set after the base class has been initialised (so SetParams doesn't cache them)
+class ExponentialGrowthModel(ODEModel):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.name = "ExponentialGrowthModel"
+        self.paramDic = {**self.paramDic, 'r': 0.1, 'N0': 10}
+        self.stateVars = ['N']
+        self.initialStateList = [self.paramDic['N0']]
+
+    def ModelEqns(self, t, uVec):
+        dudtVec = np.zeros_like(uVec)
+        dudtVec[0] = self.paramDic['r'] * uVec[0]
+        return dudtVec
+
+def test_generic_model_simulate():
+    model = ExponentialGrowthModel()
+    model.Simulate([[0, 10, 0]], dt=0.5)
+    assert model.successB
+    np.testing.assert_allclose(model.resultsDf['N'].iloc[-1], 10 * np.exp(1), rtol=1e-5)
+    np.testing.assert_allclose(model.resultsDf['TumourSize'], model.resultsDf['N'])
+
+def test_generic_model_simulate_at1():
+    model = ExponentialGrowthModel()
+    model.Simulate_AT1(t_end=5, solver_kws={'dt': 0.5})
+    assert model.successB
+    assert model.resultsDf['Time'].iloc[-1] >= 5
+
+def test_generic_model_simulate_batch():
+    model = ExponentialGrowthModel()
+    model.SimulateBatch([[0, 10, 0]], [[10], [20]], dt=0.5)
+    assert model.successB
+    finalDf = model.batchResultsDf.groupby('TrajectoryId').last()
+    np.testing.assert_allclose(finalDf['N'], [10 * np.exp(1), 20 * np.exp(1)], rtol=1e-5)
+
+# Model written for the original state layout, in which the drug concentration is passed to
+# ModelEqns as the last state variable
+class DrugKillModel(ExponentialGrowthModel):
+    def ModelEqns(self, t, uVec):
+        N, D = uVec
+        return np.array([(self.paramDic['r'] - 0.2 * D) * N, 0.])
+
+def test_drug_in_state_layout():
+    model = DrugKillModel()
+    model.Simulate([[0, 10, 1]], dt=0.5)
+    assert model.successB
+    assert list(model.resultsDf.columns) == ['Time', 'DrugConcentration', 'N', 'TumourSize']
+    np.testing.assert_allclose(model.resultsDf['N'].iloc[-1], 10 * np.exp(-1), rtol=1e-5)
+
+def test_drug_in_state_layout_batch():
+    model = DrugKillModel()
+    model.SimulateBatch([[0, 10, 1]], [[10], [20]], dt=0.5, method='BDF')
+    assert model.successB
+    finalDf = model.batchResultsDf.groupby('TrajectoryId').last()
+    np.testing.assert_allclose(finalDf['N'], [10 * np.exp(-1), 20 * np.exp(-1)], rtol=1e-4)
+
+def test_expm_requires_exact_solution():
+    model = ExponentialGrowthModel()
+    with pytest.raises(ValueError, match="SolveIntervalExact"):
+        model.Simulate([[0, 10, 0]], method='expm')
+    with pytest.raises(ValueError, match="SolveIntervalExact"):
+        model.SimulateBatch([[0, 10, 0]], [[10]], method='expm')
+
+def test_continue_after_assigning_results():
+    model = ExponentialGrowthModel()
+    model.Simulate([[0, 10, 0]], dt=0.5)
+    model.Trim(dt=1)
+    trimmedDf = model.resultsDf.copy()
+    model.Simulate([[10, 15, 0]], dt=0.5)
+    resultsDf = model.resultsDf
+    assert len(resultsDf) == len(trimmedDf) + 11
+    np.testing.assert_array_equal(resultsDf[trimmedDf.columns].iloc[:len(trimmedDf)], trimmedDf)
+    np.testing.assert_array_equal(resultsDf['N'].iloc[len(trimmedDf)], trimmedDf['N'].iloc[-1])
+
+def test_continue_after_editing_last_row():
+    model = ExponentialGrowthModel()
+    model.Simulate([[0, 10, 0]], dt=0.5)
+    model.resultsDf.loc[model.resultsDf.index[-1], 'N'] = 5.
+    model.Simulate([[10, 15, 0]], dt=0.5)
+    np.testing.assert_allclose(model.resultsDf['N'].iloc[-1], 5 * np.exp(0.5), rtol=1e-5)
+
+def test_compiled_rhs_requires_fixed_number_of_params():
+    class CompiledGrowthModel(ExponentialGrowthModel):
+        _rhsParamNames = ('r',)
+        _compiledRhs = staticmethod(lambda t, y, cfrac, p, dydt: None)
+    model = CompiledGrowthModel()
+    with pytest.raises(ValueError, match="compiled right-hand side"):
+        model.Simulate([[0, 10, 0]])
@@ -1,253 +1,235 @@
 import sys
+import functools
+from typing import NamedTuple
 import numpy as np
 sys.path.append("./")
 from odeModelClass import ODEModel
-
-# LINEAR MODEL
-
-class EinarPersistorModelType3L(ODEModel):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.name = "EinarPersistorModelType3L"
-        self.paramDic = {**self.paramDic,
-                         'CASE': 'Linear 3',
-                         'n': 1500,
-                         'fracRes': 0.01,
-                         'Cmax': 10,
-                         'k': 0.0004,
-                         'm': 0.0004,
-                         'u0': 0.0004,
-                         'v0': 0.004,
-                         'lambda0': 0.04,
-                         'lambda1': 0.001,
-                         'delta_d0': 0.08
-                        }
-        self.stateVars = ['S', 'R'] # State variables of the model. These are the variables that will be solved for in the ODE solver (Note: by default the solver will add an extra state variable for the drug concentration).
-
-    def ModelEqns(self, t, uVec):
-        dudtVec = np.zeros_like(uVec)
-        dic = self.paramDic.copy()
-        S, R, cfrac = uVec
-        
-        c = cfrac * dic['Cmax']
-        lamb = dic['lambda0'] - dic['delta_d0'] * (c / (c + 1))
-
-        u = dic['u0'] + dic['k'] * c
-        v = dic['v0'] - dic['m'] * c
-
-        dudtVec[0] = (lamb - u) * S + v * R
-        dudtVec[1] = (dic['lambda1'] - v) * R + u * S
-        dudtVec[2] = 0
-
-        return dudtVec
-
-#########################################
-
-class EinarPersistorModelType2L(ODEModel):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.name = "EinarPersistorModelType2L"
-        self.paramDic = {**self.paramDic,
-                         'CASE': 'Linear 2',
-                         'n': 1500,
-                         'fracRes': 0.01,
-                         'Cmax': 10,
-                         'k': 0.0004,
-                         'm': 0.0004,
-                         'u0': 0.0004,
-                         'v0': 0.004,
-                         'lambda0': 0.04,
-                         'lambda1': 0.001,
-                         'delta_d0': 0.08
-                        }
-        self.stateVars = ['S', 'R'] # State variables of the model. These are the variables that will be solved for in the ODE solver (Note: by default the solver will add an extra state variable for the drug concentration).
-
+import odeSolvers
+from odeSolvers import njit # Falls back to plain Python if Numba isn't installed
+
+# ====================================================================================
+# Compiled model kernels. Over each treatment interval the drug level is fixed, so the model
+# is the linear system d(S, R)/dt = A (S, R) with constant rate matrix
+#   A = [[lamb - u, v], [u, lambda1 - v]]
+# The rates kernels compute the entries (aSS, aSR, aRS, aRR) of A at the drug level cfrac.
+# They are evaluated once per interval (ODEModel.SetDrugConcentration), rather than on every
+# step of the solver, which then only has to do the matrix-vector product. The compiled
+# solvers in odeSolvers are given the entries of A in place of the model parameters (see
+# EinarPersistorModel._SolverParams), so a single right-hand side serves all model types.
+# The drug kill is written as lambda0 - delta_d0*c/(c+1) = lambda_inf + delta_d0/(c+1),
+# where lambda_inf = lambda0 - delta_d0 is the growth rate at saturating drug levels. It is
+# computed once, in _RefreshParams.
+# The kernels are compiled eagerly, for explicit signatures, when they are built (or loaded
+# from Numba's on-disk cache), so that the first simulation doesn't pay for the compilation.
+_ratesSignature = '(%s)' % ', '.join(['f8'] * 9) # cfrac and the 8 model parameters
+
+# Parameters of the kernels, in the order in which they take them (cached in ODEModel._p)
+class EinarLinearParams(NamedTuple):
+    Cmax: float
+    k: float
+    m: float
+    u0: float
+    v0: float
+    lambda_inf: float
+    lambda1: float
+    delta_d0: float
+
+class EinarUniformParams(NamedTuple):
+    Cmax: float
+    u0: float
+    v0: float
+    delta_u: float
+    delta_v: float
+    lambda_inf: float
+    lambda1: float
+    delta_d0: float
+
+# The kernels are specialised to the switching terms that a model type uses, so that the
+# compiler can drop those that are switched off (e.g. u = u0, rather than u0 + k*c with
+# k = 0, for Type 2L). The flags selecting the terms are passed to the kernels as constants
+# by the closures built in _linear_kernels/_uniform_kernels, on first use for each
+# combination of flags. These return (rates, solverParams): the kernel for the rate matrix,
+# and its entries in the form passed to the compiled solvers (see _rhs_rate_matrix).
+
+# Linear models: the switching rates change linearly with the drug concentration.
+# useK: drug increases the switching rate into the persister state (u = u0 + k*c)
+# useM: drug decreases the switching rate out of the persister state (v = v0 - m*c)
+@njit(cache=True, fastmath=True)
+def _rates_linear(useK, useM, cfrac, Cmax, k, m, u0, v0, lambda_inf, lambda1, delta_d0):
+    c = cfrac * Cmax
+    lamb = lambda_inf + delta_d0 / (c + 1.0)
+    u = u0 + k * c if useK else u0 # Switching rate from the sensitive into the persister compartment
+    v = v0 - m * c if useM else v0 # Switching rate from the persister back into the sensitive compartment
+    return lamb - u, v, u, lambda1 - v
+
+# Uniform models: the switching rates jump to u0 + delta_u and v0 - delta_v as soon as
+# any drug is present.
+# useUMax: on drug, the switching rate into the persister state rises to u0 + delta_u
+# useVMin: on drug, the switching rate out of the persister state drops to v0 - delta_v
+@njit(cache=True, fastmath=True)
+def _rates_uniform(useUMax, useVMin, cfrac, Cmax, u0, v0, delta_u, delta_v, lambda_inf, lambda1, delta_d0):
+    c = cfrac * Cmax
+    lamb = lambda_inf + delta_d0 / (c + 1.0)
+    onDrug = 1.0 * (c > 0.0)
+    u = u0 + delta_u * onDrug if useUMax else u0
+    v = v0 - delta_v * onDrug if useVMin else v0
+    return lamb - u, v, u, lambda1 - v
+
+@functools.lru_cache(maxsize=None)
+def _linear_kernels(useK, useM):
+    @njit(_ratesSignature, cache=True, fastmath=True)
+    def rates(cfrac, Cmax, k, m, u0, v0, lambda_inf, lambda1, delta_d0):
+        return _rates_linear(useK, useM, cfrac, Cmax, k, m, u0, v0, lambda_inf, lambda1, delta_d0)
+
+    @njit(odeSolvers.PARAMS_SIGNATURE, cache=True, fastmath=True)
+    def solverParams(cfrac, p):
+        aSS, aSR, aRS, aRR = _rates_linear(useK, useM, cfrac, p[0], p[1], p[2], p[3], p[4], p[5], p[6], p[7])
+        return aSS, aSR, aRS, aRR, 0., 0., 0., 0.
+    return rates, solverParams
+
+@functools.lru_cache(maxsize=None)
+def _uniform_kernels(useUMax, useVMin):
+    @njit(_ratesSignature, cache=True, fastmath=True)
+    def rates(cfrac, Cmax, u0, v0, delta_u, delta_v, lambda_inf, lambda1, delta_d0):
+        return _rates_uniform(useUMax, useVMin, cfrac, Cmax, u0, v0, delta_u, delta_v, lambda_inf, lambda1, delta_d0)
+
+    @njit(odeSolvers.PARAMS_SIGNATURE, cache=True, fastmath=True)
+    def solverParams(cfrac, p):
+        aSS, aSR, aRS, aRR = _rates_uniform(useUMax, useVMin, cfrac, p[0], p[1], p[2], p[3], p[4], p[5], p[6], p[7])
+        return aSS, aSR, aRS, aRR, 0., 0., 0., 0.
+    return rates, solverParams
+
+# Right-hand side for the compiled solvers: p holds the entries of the rate matrix for the
+# interval being solved (padded with zeros to odeSolvers.RHS_N_PARAMS, the length of the model
+# parameters), rather than the parameters themselves.
+@njit(odeSolvers.RHS_SIGNATURE, cache=True, fastmath=True)
+def _rhs_rate_matrix(t, y, cfrac, p, dydt):
+    dydt[0] = p[0] * y[0] + p[1] * y[1]
+    dydt[1] = p[2] * y[0] + p[3] * y[1]
+
+# ====================================================================================
+# Functionality shared by all of Einar's persister models
+class EinarPersistorModel(ODEModel):
+    _vectorizedB = True
+    _drugInStateB = False # ModelEqns reads the drug concentration from self.drugConcentration (via the rate matrix)
+    _rates = None # Compiled kernel returning the entries of the rate matrix, _rates(cfrac, *self._p). Set in __init__.
+    _compiledRhs = staticmethod(_rhs_rate_matrix)
+
+    def SetDrugConcentration(self, drugConcentration):
+        super().SetDrugConcentration(drugConcentration)
+        rates = self._rates(self.drugConcentration, *self._p)
+        self._rateMatrix = np.reshape(rates, (2, 2))
+        self._solverParams = (*rates, 0., 0., 0., 0.)
+
+    def _SolverParams(self):
+        return self._solverParams
+
+    # The right-hand side is a single matrix-vector product, which also returns a fresh array
+    # for the solver to keep, without first allocating and filling one element by element.
+    # (Reusing one output buffer across calls isn't safe: scipy's RK solvers keep f(t, y)
+    # from previous steps.)
     def ModelEqns(self, t, uVec):
-        dudtVec = np.zeros_like(uVec)
-        dic = self.paramDic.copy()
-        S, R, cfrac = uVec
-        
-        c = cfrac * dic['Cmax']
-        lamb = dic['lambda0'] - dic['delta_d0'] * (c / (c + 1))
+        return self._rateMatrix @ uVec
 
-        u = dic['u0']
-        v = dic['v0'] - dic['m'] * c
+    def Jacobian(self, t, uVec):
+        return self._rateMatrix.copy()
 
-        dudtVec[0] = (lamb - u) * S + v * R
-        dudtVec[1] = (dic['lambda1'] - v) * R + u * S
-        dudtVec[2] = 0
+    # The model is linear with constant coefficients over each interval, so it can be solved
+    # exactly (method='expm'), without numerical integration.
+    def SolveIntervalExact(self, tVec, currStateVec):
+        return odeSolvers.expm_linear2(self.Jacobian(tVec[0], currStateVec),
+                                       np.asarray(currStateVec, dtype=float), tVec)
 
-        return dudtVec
+# LINEAR MODEL
 
-#########################################
+class EinarPersistorModelLinear(EinarPersistorModel):
+    _rhsParamNames = ('Cmax', 'k', 'm', 'u0', 'v0', 'lambda0', 'lambda1', 'delta_d0')
+    _case = 'Linear 3'
+    _defaultParamDic = {'n': 1500,
+                        'fracRes': 0.01,
+                        'Cmax': 10,
+                        'k': 0.0004,
+                        'm': 0.0004,
+                        'u0': 0.0004,
+                        'v0': 0.004,
+                        'lambda0': 0.04,
+                        'lambda1': 0.001,
+                        'delta_d0': 0.08
+                       }
+    _useK = True # Drug increases the switching rate into the persister state (see _linear_kernels)
+    _useM = True # Drug decreases the switching rate out of the persister state
 
-class EinarPersistorModelType1L(ODEModel):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.name = "EinarPersistorModelType1L"
-        self.paramDic = {**self.paramDic,
-                         'CASE': 'Linear 1',
-                         'n': 1500,
-                         'fracRes': 0.01,
-                         'Cmax': 10,
-                         'k': 0.0004,
-                         'm': 0.0004,
-                         'u0': 0.0004,
-                         'v0': 0.004,
-                         'lambda0': 0.04,
-                         'lambda1': 0.001,
-                         'delta_d0': 0.08
-                        }
-        self.stateVars = ['S', 'R'] # State variables of the model. These are the variables that will be solved for in the ODE solver (Note: by default the solver will add an extra state variable for the drug concentration).
-
-    def ModelEqns(self, t, uVec):
-        dudtVec = np.zeros_like(uVec)
-        dic = self.paramDic.copy()
-        S, R, cfrac = uVec
-        
-        c = cfrac * dic['Cmax']
-        lamb = dic['lambda0'] - dic['delta_d0'] * (c / (c + 1))
-
-        u = dic['u0'] + dic['k'] * c
-        v = dic['v0']
-
-        dudtVec[0] = (lamb - u) * S + v * R
-        dudtVec[1] = (dic['lambda1'] - v) * R + u * S
-        dudtVec[2] = 0
-
-        return dudtVec
+        self.name = type(self).__name__
+        self.paramDic['CASE'] = self._case
+        self.paramDic.update(self._defaultParamDic)
+        self.stateVars = ['S', 'R'] # State variables of the model. These are the variables that will be solved for in the ODE solver (Note: the drug concentration is not a state variable; it is held fixed over each treatment interval).
+        self._rates, self._compiledSolverParams = _linear_kernels(self._useK, self._useM)
+        self._RefreshParams()
+
+    def _RefreshParams(self):
+        super()._RefreshParams()
+        Cmax, k, m, u0, v0, lambda0, lambda1, delta_d0 = self._p
+        self._p = EinarLinearParams(Cmax=Cmax, k=k if self._useK else 0., m=m if self._useM else 0.,
+                                    u0=u0, v0=v0, lambda_inf=lambda0 - delta_d0,
+                                    lambda1=lambda1, delta_d0=delta_d0)
+        self.SetDrugConcentration(self.drugConcentration)
+
+class EinarPersistorModelType3L(EinarPersistorModelLinear):
+    _case = 'Linear 3'
+
+class EinarPersistorModelType2L(EinarPersistorModelLinear):
+    _case = 'Linear 2'
+    _useK = False
+
+class EinarPersistorModelType1L(EinarPersistorModelLinear):
+    _case = 'Linear 1'
+    _useM = False
 
 # UNIFORM MODEL
 
-class EinarPersistorModelTypeU(ODEModel):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.name = "EinarPersistorModelTypeU"
-        self.paramDic = {**self.paramDic,
-                         'CASE': 'Uniform',
-                         'n': 1500,
-                         'fracRes': 0.01,
-                         'Cmax': 10,
-                         'u0': 0.0004,
-                         'v0': 0.004,
-                         'lambda0': 0.04,
-                         'lambda1': 0.001,
-                         'delta_d0': 0.08,
-                         'delta_u': 0.004,
-                         'delta_v': 0.003
-                        }
-        self.stateVars = ['S', 'R'] # State variables of the model. These are the variables that will be solved for in the ODE solver (Note: by default the solver will add an extra state variable for the drug concentration).
+class EinarPersistorModelUniform(EinarPersistorModel):
+    _rhsParamNames = ('Cmax', 'u0', 'v0', 'delta_u', 'delta_v', 'lambda0', 'lambda1', 'delta_d0')
+    _case = 'Uniform'
+    _defaultParamDic = {'n': 1500,
+                        'fracRes': 0.01,
+                        'Cmax': 10,
+                        'u0': 0.0004,
+                        'v0': 0.004,
+                        'lambda0': 0.04,
+                        'lambda1': 0.001,
+                        'delta_d0': 0.08,
+                        'delta_u': 0.004,
+                        'delta_v': 0.003
+                       }
+    _useUMax = True # On drug, the switching rate into the persister state rises (see _uniform_kernels)
+    _useVMin = True # On drug, the switching rate out of the persister state drops
+    _name = "EinarPersistorModelTypeU" # Shared by all uniform model types, as in existing results and plots
 
-    def ModelEqns(self, t, uVec):
-        dudtVec = np.zeros_like(uVec)
-        dic = self.paramDic.copy()
-        S, R, cfrac = uVec
-        
-        c = cfrac * dic['Cmax']
-        lamb = dic['lambda0'] - dic['delta_d0'] * (c / (c + 1))
-        
-        u_max = dic['u0'] + dic['delta_u']
-        v_min = dic['v0'] - dic['delta_v']
-
-        if c > 0:
-            u = u_max
-            v = v_min
-        else:
-            u = dic['u0']
-            v = dic['v0']
-
-        dudtVec[0] = (lamb - u) * S + v * R
-        dudtVec[1] = (dic['lambda1'] - v) * R + u * S
-        dudtVec[2] = 0
-
-        return dudtVec
-
-#######################################
-    
-class EinarPersistorModelTypeU1(ODEModel):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.name = "EinarPersistorModelTypeU"
-        self.paramDic = {**self.paramDic,
-                         'CASE': 'Uniform',
-                         'n': 1500,
-                         'fracRes': 0.01,
-                         'Cmax': 10,
-                         'u0': 0.0004,
-                         'v0': 0.004,
-                         'lambda0': 0.04,
-                         'lambda1': 0.001,
-                         'delta_d0': 0.08,
-                         'delta_u': 0.004,
-                         'delta_v': 0.003
-                        }
-        self.stateVars = ['S', 'R'] # State variables of the model. These are the variables that will be solved for in the ODE solver (Note: by default the solver will add an extra state variable for the drug concentration).
-
-    def ModelEqns(self, t, uVec):
-        dudtVec = np.zeros_like(uVec)
-        dic = self.paramDic.copy()
-        S, R, cfrac = uVec
-        
-        c = cfrac * dic['Cmax']
-        lamb = dic['lambda0'] - dic['delta_d0'] * (c / (c + 1))
-        
-        u_max = dic['u0'] + dic['delta_u']
-        v_min = dic['v0'] - dic['delta_v']
-
-        if c > 0:
-            u = u_max
-            v = dic['v0']
-        else:
-            u = dic['u0']
-            v = dic['v0']
-
-        dudtVec[0] = (lamb - u) * S + v * R
-        dudtVec[1] = (dic['lambda1'] - v) * R + u * S
-        dudtVec[2] = 0
-
-        return dudtVec
-    
-######################################
-    
-class EinarPersistorModelTypeU2(ODEModel):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.name = "EinarPersistorModelTypeU"
-        self.paramDic = {**self.paramDic,
-                         'CASE': 'Uniform',
-                         'n': 1500,
-                         'fracRes': 0.01,
-                         'Cmax': 10,
-                         'u0': 0.0004,
-                         'v0': 0.004,
-                         'lambda0': 0.04,
-                         'lambda1': 0.001,
-                         'delta_d0': 0.08,
-                         'delta_u': 0.004,
-                         'delta_v': 0.003
-                        }
-        self.stateVars = ['S', 'R'] # State variables of the model. These are the variables that will be solved for in the ODE solver (Note: by default the solver will add an extra state variable for the drug concentration).
-
-    def ModelEqns(self, t, uVec):
-        dudtVec = np.zeros_like(uVec)
-        dic = self.paramDic.copy()
-        S, R, cfrac = uVec
-        
-        c = cfrac * dic['Cmax']
-        lamb = dic['lambda0'] - dic['delta_d0'] * (c / (c + 1))
-        
-        u_max = dic['u0'] + dic['delta_u']
-        v_min = dic['v0'] - dic['delta_v']
-
-        if c > 0:
-            u = dic['u0']
-            v = v_min
-        else:
-            u = dic['u0']
-            v = dic['v0']
-
-        dudtVec[0] = (lamb - u) * S + v * R
-        dudtVec[1] = (dic['lambda1'] - v) * R + u * S
-        dudtVec[2] = 0
-
-        return dudtVec
\ No newline at end of file
+        self.name = self._name
+        self.paramDic['CASE'] = self._case
+        self.paramDic.update(self._defaultParamDic)
+        self.stateVars = ['S', 'R'] # State variables of the model. These are the variables that will be solved for in the ODE solver (Note: the drug concentration is not a state variable; it is held fixed over each treatment interval).
+        self._rates, self._compiledSolverParams = _uniform_kernels(self._useUMax, self._useVMin)
+        self._RefreshParams()
+
+    def _RefreshParams(self):
+        super()._RefreshParams()
+        Cmax, u0, v0, delta_u, delta_v, lambda0, lambda1, delta_d0 = self._p
+        self._p = EinarUniformParams(Cmax=Cmax, u0=u0, v0=v0,
+                                     delta_u=delta_u if self._useUMax else 0.,
+                                     delta_v=delta_v if self._useVMin else 0.,
+                                     lambda_inf=lambda0 - delta_d0, lambda1=lambda1, delta_d0=delta_d0)
+        self.SetDrugConcentration(self.drugConcentration)
+
+class EinarPersistorModelTypeU(EinarPersistorModelUniform):
+    pass
+
+class EinarPersistorModelTypeU1(EinarPersistorModelUniform):
+    _useVMin = False
+
+class EinarPersistorModelTypeU2(EinarPersistorModelUniform):
+    _useUMax = False
@@ -3,6 +3,8 @@
 # ====================================================================================
 import numpy as np
 import scipy.integrate
+import scipy.optimize
+import scipy.sparse
 import pandas as pd
 import os
 import sys
@@ -15,13 +17,38 @@ import seaborn as sns
 sns.set(style="white")
 sys.path.append("./")
 import myUtils as utils
+import odeSolvers
+try:
+    import joblib
+    JOBLIB_AVAILABLE = True
+except ImportError:  # Sweeps then run one simulation after the other
+    JOBLIB_AVAILABLE = False
 
 class ODEModel():
+    _rhsParamNames = ()  # Parameters passed to the compiled right-hand side (in order), cached in self._p
+    _vectorizedB = False  # Whether ModelEqns accepts states of shape (n_vars, n_points) as well as (n_vars,)
+    Jacobian = None  # Models can provide the analytic Jacobian of ModelEqns, Jacobian(t, uVec), for use by the implicit solvers
+    _compiledRhs = None  # Models can provide a Numba-compiled rhs(t, y, drugConcentration, p, dydt) for the solvers in odeSolvers, with p = self._SolverParams(), a tuple of odeSolvers.RHS_N_PARAMS floats
+    _compiledMethods = {'RK45': odeSolvers.rk45, 'DOP853': odeSolvers.dop853} if odeSolvers.NUMBA_AVAILABLE else {}  # Methods for which a compiled solver is available
+    _compiledSweepMethods = {'RK45': odeSolvers.rk45_sweep} if odeSolvers.NUMBA_AVAILABLE else {}  # Methods for which a compiled, parallel solver for batches of trajectories is available
+    _compiledSolverParams = staticmethod(odeSolvers.model_params)  # Compiled counterpart of _SolverParams, solverParams(drugConcentration, p), used by the compiled adaptive therapy sweeps
+    SolveIntervalExact = None  # Models which can be solved in closed form over an interval can provide SolveIntervalExact(tVec, stateVec), used with method='expm'
+    _drugInStateB = True  # Whether ModelEqns takes the drug concentration as an extra, last state variable (see _SolveInterval)
+
     def __init__(self, **kwargs):
         # Initialise parameters
         self.paramDic = {'DMax':100}
         self.stateVars = ['P1']
+        self.drugConcentration = 0.  # Drug concentration in the interval being solved. Not a state variable, as it's constant over each interval.
         self.resultsDf = None
+        self._nextStepSize = 0.  # Step size with which the compiled solver continues into the next interval (0: choose automatically)
+        self._y0Buf = None  # State at the start of the interval being solved (allocated once, in _SimulateCore)
+        self._doseRegimeEnd = None  # End of the time span over which dose regimes are solved ahead (see _DoseRegimes); None: off
+        self._tGrid = None  # Time grid the adaptive therapy loops slice their intervals' time points out of (see _TimeGrid); None: off
+        self._tGridDt = None  # dt the time grid was built with
+        self._outputSuppressedB = False  # Whether stdout is already redirected (see _SuppressSolverOutput)
+        self._rawP = None  # paramDic entries the cached parameters were built from (None: not cached yet; see _RefreshParams)
+        self._p = ()  # Cached parameters passed to the right-hand side
 
         # Set the parameters
         self.SetParams(**kwargs)
@@ -32,6 +59,10 @@ class ODEModel():
         self.relErr = kwargs.get('relErr', 1.0e-6)  # Relative error allowed for ODE solver
         self.solverMethod = kwargs.get('method', 'DOP853')  # ODE solver used
         self.max_step = kwargs.get('max_step', np.inf) # Maximum step size permitted by solver
+        self.useNumbaB = kwargs.get('useNumbaB', True)  # Use the compiled solver, if the model and method support it
+        self.jacSparsity = kwargs.get('jac_sparsity', None)  # Sparsity structure of the Jacobian of ModelEqns (nVars x nVars; nonzero where the derivative of a variable depends on a state variable), for the implicit solvers if the model has no analytic Jacobian (None: dense)
+        self.storePrecision = kwargs.get('store_precision', 'float64')  # Floating point type in which resultsDf holds the states and tumour size (see _ResultsColumns)
+        self.stiffSwitchThreshold = kwargs.get('stiffSwitchThreshold', None)  # If set, switch from an explicit method to LSODA once an interval needs more than this many evaluations of the RHS per unit time (a sign of stiffness)
         self.numericalStabilisationB = kwargs.get('numericalStabilisationB', False)  # Whether to apply numerical stabilisation
         self.suppressOutputB = kwargs.get('suppressOutputB',
                                           False)  # If true, suppress output of ODE solver (including warning messages)
@@ -44,30 +75,302 @@ class ODEModel():
             for key in self.paramDic.keys():
                 self.paramDic[key] = float(kwargs.get(key, self.paramDic[key]))
             self.initialStateList = [self.paramDic[var + "0"] for var in self.stateVars]
+            self._RefreshParams()
 
     # =========================================================================================
-    # Function to simulate the model
-    def Simulate(self, treatmentScheduleList, **kwargs):
-        # Allow configuring the solver at this point as well
+    # Cache the parameters used by ModelEqns as a tuple of floats, so that the solver doesn't
+    # look them up in paramDic on every step. Needs to be called whenever paramDic changes.
+    # Models may store a NamedTuple instead, to access the parameters by name.
+    def _RefreshParams(self):
+        self._rawP = tuple(self.paramDic[key] for key in self._rhsParamNames)
+        self._p = tuple(float(x) for x in self._rawP)
+        if self._compiledRhs is not None and len(self._p) != odeSolvers.RHS_N_PARAMS:
+            raise ValueError("Models with a compiled right-hand side need to have %d parameters (_rhsParamNames); %s has %d."
+                             % (odeSolvers.RHS_N_PARAMS, type(self).__name__, len(self._p)))
+        self._nextStepSize = 0.  # The dynamics change, so let the solver choose its step size afresh
+
+    # Whether paramDic has changed since the parameters were last cached. The simulation
+    # functions check this, rather than rebuilding the cached parameters on every call (the
+    # adaptive therapy functions call Simulate once per interval).
+    def _ParamsChangedB(self):
+        return self._rawP is None or tuple(self.paramDic[key] for key in self._rhsParamNames) != self._rawP
+
+    # =========================================================================================
+    # Set the drug concentration for the interval that is about to be solved. Models can extend
+    # this to precompute any quantities that only change when the drug concentration does.
+    def SetDrugConcentration(self, drugConcentration):
+        self.drugConcentration = float(drugConcentration)
+
+    # Parameters passed to the compiled right-hand side for the current interval. Models can
+    # override this to pass quantities precomputed in SetDrugConcentration instead.
+    def _SolverParams(self):
+        return tuple(self._p)
+
+    # =========================================================================================
+    # Update the solver configuration from the keyword arguments passed to one of the Simulate functions
+    def _ConfigureSolver(self, **kwargs):
         self.dt = float(kwargs.get('dt', self.dt))  # Time resolution to return the model prediction on
         self.absErr = kwargs.get('absErr', self.absErr)  # Absolute error allowed for ODE solver
         self.relErr = kwargs.get('relErr', self.relErr)  # Relative error allowed for ODE solver
         self.solverMethod = kwargs.get('method', self.solverMethod)  # ODE solver used
         self.max_step = kwargs.get('max_step', self.max_step) # Maximum step size permitted by solver
-        self.successB = False  # Indicate successful solution of the ODE system
+        self.useNumbaB = kwargs.get('useNumbaB', self.useNumbaB)  # Use the compiled solver, if the model and method support it
+        self.stiffSwitchThreshold = kwargs.get('stiffSwitchThreshold', self.stiffSwitchThreshold)  # If set, switch from an explicit method to LSODA once an interval needs more than this many evaluations of the RHS per unit time
         self.suppressOutputB = kwargs.get('suppressOutputB',
                                           self.suppressOutputB)  # If true, suppress output of ODE solver (including warning messages)
         self.numericalStabilisationB = kwargs.get('numericalStabilisationB', self.numericalStabilisationB)  # Whether to apply numerical stabilisation
+        if self.solverMethod == 'expm' and self.SolveIntervalExact is None:
+            raise ValueError("method='expm' requires a model which provides SolveIntervalExact; use one of the "
+                             "solve_ivp methods (e.g. 'RK45', 'DOP853', 'LSODA', 'BDF', 'Radau') instead.")
 
-        # Solve
-        self.treatmentScheduleList = treatmentScheduleList
-        if self.resultsDf is None or treatmentScheduleList[0][0] == 0:
-            currStateVec = self.initialStateList + [0]
-            self.resultsDf = None
-        else:
-            currStateVec = [self.resultsDf[var].iloc[-1] for var in self.stateVars] + [self.resultsDf['DrugConcentration'].iloc[-1]]
-        resultsDFList = []
-        encounteredProblemB = False
+    # =========================================================================================
+    # Supply the analytic Jacobian to the solver if the model has one and the solver can use it.
+    # Only the implicit methods take a Jacobian (the explicit ones warn if given one); without it
+    # they estimate it by finite differences, costing extra evaluations of ModelEqns. If the
+    # sparsity structure of the Jacobian is given (jac_sparsity), passing it on lets them do so
+    # with fewer evaluations (BDF and Radau take it as jac_sparsity, LSODA as the widths of the
+    # band of nonzero entries).
+    def _JacobianOptions(self):
+        if self.solverMethod not in ('BDF', 'Radau', 'LSODA'):
+            return {}
+        if self.Jacobian is not None:
+            return {'jac': self.Jacobian}
+        sparsityMat = self.JacobianSparsity()
+        if sparsityMat is None:
+            return {}
+        rowIdx, colIdx = np.nonzero(sparsityMat)
+        if len(rowIdx) == sparsityMat.size:
+            return {}
+        if self.solverMethod == 'LSODA':
+            lband, uband = int(np.max(rowIdx - colIdx, initial=0)), int(np.max(colIdx - rowIdx, initial=0))
+            return {'lband': lband, 'uband': uband} if min(lband, uband) < len(sparsityMat) - 1 else {}
+        return {'jac_sparsity': scipy.sparse.csc_matrix(sparsityMat)}
+
+    # Sparsity structure of the Jacobian of ModelEqns, as a boolean nVars x nVars array, if it's
+    # given as jac_sparsity (None otherwise)
+    def JacobianSparsity(self):
+        sparsityMat = self.jacSparsity
+        if sparsityMat is None:
+            return None
+        return sparsityMat.toarray() != 0 if scipy.sparse.issparse(sparsityMat) else np.asarray(sparsityMat) != 0
+
+    # =========================================================================================
+    # Explicit methods become very expensive on stiff problems, as their step size is limited by
+    # stability rather than accuracy. If stiffSwitchThreshold is set, detect this from the number
+    # of evaluations of the right-hand side the solver needed over the last interval, and switch
+    # to LSODA (which chooses between stiff and non-stiff methods itself) for what follows.
+    # The switch only holds until the function that was called (Simulate, or one of the adaptive
+    # therapy or long term assay loops) returns: _StiffnessSwitch then restores solverMethod.
+    def _CheckStiffness(self, solObj, interval):
+        if self.stiffSwitchThreshold is None or self.solverMethod not in ('RK23', 'RK45', 'DOP853'):
+            return
+        intervalLength = interval[1] - interval[0]
+        if intervalLength > 0 and solObj.nfev / intervalLength > self.stiffSwitchThreshold:
+            self.solverMethod = 'LSODA'
+
+    @contextlib.contextmanager
+    def _StiffnessSwitch(self):
+        solverMethod = self.solverMethod
+        try:
+            yield
+        finally:
+            self.solverMethod = solverMethod
+
+    # =========================================================================================
+    # Redirect stdout while the solver runs, if suppressOutputB is set. Redirecting is costly
+    # compared to solving a short interval, so functions that solve many intervals in a row
+    # (e.g. the adaptive therapy ones) redirect once around the whole loop; nested calls then
+    # leave the redirection in place.
+    @contextlib.contextmanager
+    def _SuppressSolverOutput(self):
+        if not self.suppressOutputB or self._outputSuppressedB:
+            yield
+            return
+        with stdout_redirected():
+            self._outputSuppressedB = True
+            try:
+                yield
+            finally:
+                self._outputSuppressedB = False
+
+    # =========================================================================================
+    # Solve the model over a single treatment interval, during which the drug concentration is
+    # fixed, returning the solution at the time points in tVec. If the model provides a compiled
+    # right-hand side, and a compiled version of the chosen method is available, the integration
+    # runs entirely in compiled code. In this case the solver carries its step size over from one
+    # interval to the next if the drug concentration stays the same (including across calls to
+    # Simulate that continue a simulation, as in the adaptive therapy loops), rather than
+    # choosing it afresh each time.
+    # Otherwise it goes through scipy.integrate.solve_ivp.
+    # With method='expm', models which provide SolveIntervalExact are solved in closed form.
+    # currStateVec and the solution returned only hold stateVars. Models written for the original
+    # state layout (_drugInStateB) get the drug concentration as an extra, last state variable,
+    # with zero derivative: it is appended to the state passed to solve_ivp, and removed again
+    # from the solution. Their Jacobian and jac_sparsity then cover it as well. Models can set
+    # _drugInStateB = False to receive only stateVars, and read self.drugConcentration instead.
+    def _SolveInterval(self, tVec, currStateVec, drugConcentration, solverOptions={}):
+        t_span = (tVec[0], tVec[-1] + self.dt)
+        if float(drugConcentration) != self.drugConcentration:
+            self._nextStepSize = 0.  # The dynamics change, so let the solver choose its step size afresh
+        self.SetDrugConcentration(drugConcentration)
+        if self.solverMethod == 'expm' and self.SolveIntervalExact is not None:
+            yMat = self.SolveIntervalExact(tVec, currStateVec)
+            return scipy.optimize.OptimizeResult(t=tVec, y=yMat, nfev=0, njev=0, nlu=0, status=0,
+                                                 message="Solved exactly using the matrix exponential.", success=True)
+        if self.useNumbaB and self._compiledRhs is not None and self.solverMethod in self._compiledMethods:
+            yMat, status, nfev, self._nextStepSize = self._compiledMethods[self.solverMethod](
+                self._compiledRhs, float(t_span[0]), float(t_span[1]),
+                np.asarray(currStateVec, dtype=float), tVec, self.drugConcentration, self._SolverParams(),
+                float(self.absErr), float(self.relErr), float(self.max_step), self._nextStepSize)
+            message = ("The solver successfully reached the end of the integration interval." if status == odeSolvers.SUCCESS
+                       else "Required step size is less than spacing between numbers.")
+            return scipy.optimize.OptimizeResult(t=tVec, y=yMat, nfev=nfev, njev=0, nlu=0,
+                                                 status=status, message=message, success=status >= 0)
+        y0 = np.append(currStateVec, self.drugConcentration) if self._drugInStateB else currStateVec
+        solObj = None
+        if self._doseRegimeEnd is not None:
+            solObj = self._SolveFromDoseRegime(tVec, y0, solverOptions)
+        if solObj is None:
+            with self._SuppressSolverOutput():
+                solObj = scipy.integrate.solve_ivp(self.ModelEqns, y0=y0,
+                                                   t_span=t_span, t_eval=tVec,
+                                                   method=self.solverMethod,
+                                                   atol=self.absErr, rtol=self.relErr,
+                                                   max_step=self.max_step, vectorized=self._vectorizedB,
+                                                   **solverOptions)
+        if self._drugInStateB:
+            solObj.y = solObj.y[:-1]
+        return solObj
+
+    # =========================================================================================
+    # The adaptive therapy functions solve one interval at a time, which through solve_ivp means
+    # setting up the solver (including choosing its initial step size) afresh for every interval.
+    # Within _DoseRegimes, the model is instead solved with dense output over several intervals
+    # ahead at a time, assuming the dose stays the same, and the following intervals are read off
+    # this solution for as long as they continue it at the same drug concentration. A new solution
+    # is started when the dose changes or the solution runs out. The number of intervals solved
+    # ahead doubles each time it runs out, and halves each time the dose changes first, so that
+    # little is solved in vain when the dose changes often. An interval which doesn't continue
+    # from where the last one ended (e.g. as the time points of each interval overshoot its end,
+    # see _GridTimes) is solved on its own, as none of a solution ahead could be used, and
+    # solving ahead starts again from a single interval once one does.
+    @contextlib.contextmanager
+    def _DoseRegimes(self, tEnd):
+        self._doseRegimeEnd, self._doseRegime, self._nIntervalsAhead = tEnd, None, 1
+        try:
+            yield
+        finally:
+            self._doseRegimeEnd = self._doseRegime = None
+
+    # Solution over the interval from the current dose regime, or None if the solver fails, in
+    # which case the interval is solved on its own
+    def _SolveFromDoseRegime(self, tVec, currStateVec, solverOptions):
+        t_span = (tVec[0], tVec[-1] + self.dt)
+        regime = self._doseRegime
+        continuesB = regime is not None and tVec[0] == regime['tLast'] and np.array_equal(currStateVec, regime['yLast'])
+        if not continuesB:
+            self._nIntervalsAhead = 1
+            with self._SuppressSolverOutput():
+                solObj = scipy.integrate.solve_ivp(self.ModelEqns, y0=currStateVec,
+                                                   t_span=t_span, t_eval=tVec,
+                                                   method=self.solverMethod,
+                                                   atol=self.absErr, rtol=self.relErr,
+                                                   max_step=self.max_step, vectorized=self._vectorizedB,
+                                                   **solverOptions)
+            self._doseRegime = ({'sol': None, 'drugConcentration': self.drugConcentration,
+                                 'tLast': tVec[-1], 'yLast': solObj.y[:, -1].copy()} if solObj.success else None)
+            return solObj
+        if not (regime['sol'] is not None and regime['drugConcentration'] == self.drugConcentration
+                and t_span[1] <= regime['sol'].t_max):
+            if regime['drugConcentration'] != self.drugConcentration:
+                self._nIntervalsAhead = max(self._nIntervalsAhead // 2, 1)
+            else:
+                self._nIntervalsAhead *= 2
+            tEnd = max(min(t_span[0] + self._nIntervalsAhead * (t_span[1] - t_span[0]), self._doseRegimeEnd), t_span[1])
+            with self._SuppressSolverOutput():
+                solObj = scipy.integrate.solve_ivp(self.ModelEqns, y0=currStateVec,
+                                                   t_span=(t_span[0], tEnd), dense_output=True,
+                                                   method=self.solverMethod,
+                                                   atol=self.absErr, rtol=self.relErr,
+                                                   max_step=self.max_step, vectorized=self._vectorizedB,
+                                                   **solverOptions)
+            if not solObj.success:
+                self._doseRegime = None
+                return None
+            regime = self._doseRegime = {'sol': solObj.sol, 'drugConcentration': self.drugConcentration,
+                                         'nfevRate': solObj.nfev / (tEnd - t_span[0])}
+        yMat = regime['sol'](tVec)
+        yMat[:, 0] = currStateVec  # Exactly, rather than as interpolated, so that the repeated time point is recognised
+        regime['tLast'], regime['yLast'] = tVec[-1], yMat[:, -1].copy()
+        return scipy.optimize.OptimizeResult(t=tVec, y=yMat, nfev=int(round(regime['nfevRate'] * (t_span[1] - t_span[0]))),
+                                             njev=0, nlu=0, status=0, success=True,
+                                             message="The solver successfully reached the end of the integration interval.")
+
+    # =========================================================================================
+    # The results of the simulations are stored in a preallocated buffer (one row per time
+    # point, with the columns of _ResultsColumns), which grows by doubling as simulations are
+    # continued, rather than being concatenated onto at every call. The resultsDf DataFrame
+    # is only built from it when it is accessed. resultsDf can still be assigned to; the
+    # buffer is then reloaded from it when the simulation is continued. Edits to the resultsDf
+    # returned are only taken over into the buffer for its last row, which a continued simulation
+    # starts from (comparing the whole DataFrame on every call would cost as much as the
+    # concatenation the buffer avoids). Edits to any earlier row are lost when the simulation is
+    # continued; to change those, assign a modified copy to resultsDf instead.
+    # The buffer is float64; resultsDf stores the states and tumour size in storePrecision.
+    # 'float32' halves the memory of long simulations, but isn't suitable for fitting, as the
+    # finite-difference gradients fall below float32 resolution. The solver, and the state
+    # carried between intervals, always use float64, as do the times and drug concentrations
+    # in resultsDf, so that they compare equal to the values in the treatment schedule.
+    def _ResultsColumns(self):
+        return ['Time', 'DrugConcentration', *self.stateVars, 'TumourSize']
+
+    @property
+    def resultsDf(self):
+        if self._resultsDf is None and self._nResults > 0:
+            resultsMat = self._resultsBuf[:self._nResults]
+            self._resultsDf = pd.DataFrame(resultsMat[:, 2:].astype(self.storePrecision), columns=self._ResultsColumns()[2:])
+            self._resultsDf.insert(0, 'Time', resultsMat[:, 0].copy())
+            self._resultsDf.insert(1, 'DrugConcentration', resultsMat[:, 1].copy())
+        return self._resultsDf
+
+    @resultsDf.setter
+    def resultsDf(self, resultsDf):
+        self._resultsDf = resultsDf
+        self._resultsBuf = None
+        self._nResults = 0 if resultsDf is None else len(resultsDf)
+
+    # Bring the buffer up to date with resultsDf, in case this has been assigned, or its last
+    # row modified
+    def _SyncResultsBuffer(self):
+        resultsDf = self._resultsDf
+        if resultsDf is None:
+            return
+        columnsList = self._ResultsColumns()
+        if self._resultsBuf is None or len(resultsDf) != self._nResults:
+            self._resultsBuf = resultsDf[columnsList].to_numpy(dtype=float, copy=True)
+            self._nResults = len(resultsDf)
+        elif self._nResults > 0:
+            # Only take over the entries that have been changed, so that the state isn't
+            # rounded to storePrecision when resultsDf has merely been looked at
+            bufRowVec = self._resultsBuf[self._nResults - 1]
+            for i, column in enumerate(columnsList):
+                value = resultsDf[column].iat[-1]
+                if value != bufRowVec[i].astype(resultsDf[column].dtype):
+                    bufRowVec[i] = value
+
+    # Make space for nNewRows more rows of results
+    def _ReserveResults(self, nNewRows):
+        nRequired = self._nResults + nNewRows
+        if self._resultsBuf is None:
+            self._resultsBuf = np.empty((nRequired, len(self._ResultsColumns())))
+        elif self._resultsBuf.shape[0] < nRequired:
+            newBuf = np.empty((max(2 * self._resultsBuf.shape[0], nRequired), self._resultsBuf.shape[1]))
+            newBuf[:self._nResults] = self._resultsBuf[:self._nResults]
+            self._resultsBuf = newBuf
+
+    # Time points at which to return the solution in each interval of a treatment schedule
+    def _IntervalTimes(self, treatmentScheduleList):
+        tVecList = []
         for intervalId, interval in enumerate(treatmentScheduleList):
             tVec = np.arange(interval[0], interval[1], self.dt)
             if intervalId == (len(treatmentScheduleList) - 1):
@@ -76,20 +379,84 @@ class ODEModel():
                 # final time point is cut off. To ensure it's included in tVec,
                 # manually insert it, if this happens.
                 if tVec[-1] <= interval[1]: tVec[-1] = interval[1]
-            currStateVec[-1] = interval[2]
-            if self.suppressOutputB:
-                with stdout_redirected():
-                    solObj = scipy.integrate.solve_ivp(self.ModelEqns, y0=currStateVec,
-                                                       t_span=(tVec[0], tVec[-1] + self.dt), t_eval=tVec,
-                                                       method=self.solverMethod,
-                                                       atol=self.absErr, rtol=self.relErr,
-                                                       max_step=self.max_step)
-            else:
-                solObj = scipy.integrate.solve_ivp(self.ModelEqns, y0=currStateVec,
-                                                   t_span=(tVec[0], tVec[-1] + self.dt), t_eval=tVec,
-                                                   method=self.solverMethod,
-                                                   atol=self.absErr, rtol=self.relErr,
-                                                   max_step=self.max_step)
+            tVecList.append(tVec)
+        return tVecList
+
+    # =========================================================================================
+    # The adaptive therapy functions simulate one interval at a time. Rather than creating the
+    # time points of each interval anew, they are sliced out of a single grid covering the whole
+    # simulation. _TimeGrid creates the grid for the duration of the loop; _GridTimes returns the
+    # time points for an interval (the same number of points as Simulate would use for it as the
+    # final interval), provided the interval starts on the grid and dt hasn't changed since it
+    # was created. Otherwise, it falls back to creating them as Simulate would.
+    @contextlib.contextmanager
+    def _TimeGrid(self, tStart, tEnd):
+        self._tGrid = tStart + self.dt * np.arange(int(np.ceil((tEnd - tStart) / self.dt)) + 3)
+        self._tGridDt = self.dt
+        try:
+            yield
+        finally:
+            self._tGrid = None
+
+    def _GridTimes(self, interval):
+        tGrid = self._tGrid
+        if tGrid is not None and self._tGridDt == self.dt:
+            startIdx = int(round((interval[0] - tGrid[0]) / self.dt))
+            nPoints = int(np.ceil((interval[1] + self.dt - interval[0]) / self.dt))
+            if 0 <= startIdx and startIdx + nPoints <= len(tGrid) and abs(tGrid[startIdx] - interval[0]) <= 1e-9 * max(1, abs(interval[0])):
+                return tGrid[startIdx:startIdx + nPoints]
+        return self._IntervalTimes([interval])[0]
+
+    # =========================================================================================
+    # Function to simulate the model
+    # initialStateVec: State to start from, in place of initialStateList (or, when continuing a
+    # previous simulation, the last state saved, which is then replaced by it; used to reseed
+    # the cells in the long term assays).
+    def Simulate(self, treatmentScheduleList, tVecList=None, initialStateVec=None, **kwargs):
+        # Allow configuring the solver at this point as well
+        self._ConfigureSolver(**kwargs)
+        if self._ParamsChangedB(): self._RefreshParams()  # paramDic may have been modified or replaced since the last call
+        with self._StiffnessSwitch():
+            self._SimulateCore(treatmentScheduleList, tVecList, initialStateVec)
+
+    # =========================================================================================
+    # Solve the model over the treatment schedule and save the results in the results buffer,
+    # without any pandas; resultsDf is only built from the buffer when it's accessed. Returns
+    # the time points, drug concentrations and states (nVars x nTimePoints) saved, as views into
+    # the buffer. Assumes the solver and parameters are already set up, so that the adaptive
+    # therapy functions can do this once and then call it directly for each interval.
+    def _SimulateCore(self, treatmentScheduleList, tVecList=None, initialStateVec=None):
+        self.successB = False  # Indicate successful solution of the ODE system
+        self.treatmentScheduleList = treatmentScheduleList
+        nVars = len(self.stateVars)
+        # The state at the start of each interval is kept in the same array throughout
+        if self._y0Buf is None or len(self._y0Buf) != nVars:
+            self._y0Buf = np.empty(nVars)
+        currStateVec = self._y0Buf
+        if self._nResults == 0 or treatmentScheduleList[0][0] == 0:
+            currStateVec[:] = self.initialStateList if initialStateVec is None else initialStateVec
+            self.resultsDf = None
+            self._nextStepSize = 0.
+        else:
+            self._SyncResultsBuffer()
+            if initialStateVec is not None:
+                self._resultsBuf[self._nResults - 1, 2:2 + nVars] = initialStateVec
+                self._resultsBuf[self._nResults - 1, -1] = self.RunCellCountToTumourSizeModel(
+                    pd.DataFrame([initialStateVec], columns=self.stateVars))[0]
+                self._resultsDf = None
+                self._nextStepSize = 0.  # The state jumps, so the step size carried over no longer applies
+            currStateVec[:] = self._resultsBuf[self._nResults - 1, 2:2 + nVars]
+        tVecList = self._IntervalTimes(treatmentScheduleList) if tVecList is None else tVecList
+        self._ReserveResults(sum(len(tVec) for tVec in tVecList))
+        startRow = currRow = self._nResults
+        encounteredProblemB = False
+        solverOptions = self._JacobianOptions()
+        # With the default cell count to tumour size model, the tumour size is computed as the
+        # results are saved, rather than in a second pass over them
+        fuseTumourSizeB = type(self).RunCellCountToTumourSizeModel is ODEModel.RunCellCountToTumourSizeModel
+        theta = self.paramDic.get('scaleFactor', 1)
+        for tVec, interval in zip(tVecList, treatmentScheduleList):
+            solObj = self._SolveInterval(tVec, currStateVec, interval[2], solverOptions)
             # Check that the solver converged
             self.errMessage = ""
             self.solObj = solObj
@@ -110,26 +477,247 @@ class ODEModel():
                 print(self.errMessage)
                 print("xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
             if encounteredProblemB: break
+            self._CheckStiffness(solObj, interval)
+            if self.solverMethod == 'LSODA' and 'jac' not in solverOptions:
+                solverOptions = self._JacobianOptions()
 
-            # Save results
-            resultsDFList.append(
-                pd.DataFrame({"Time": tVec, "DrugConcentration": solObj.y[-1, :],
-                              **dict(zip(self.stateVars,solObj.y))}))
-            currStateVec = solObj.y[:, -1]
+            # Save results. When continuing a previous simulation (as the adaptive therapy functions
+            # do), the first time point repeats the last one saved. Skip it if it's identical.
+            yMat, tVec = solObj.y, np.asarray(tVec)
+            if (currRow == startRow > 0 and tVec[0] == self._resultsBuf[currRow - 1, 0]
+                    and interval[2] == self._resultsBuf[currRow - 1, 1]
+                    and np.array_equal(yMat[:, 0], self._resultsBuf[currRow - 1, 2:2 + nVars])):
+                yMat, tVec = yMat[:, 1:], tVec[1:]
+            nRows = len(tVec)
+            self._resultsBuf[currRow:currRow + nRows, 0] = tVec
+            self._resultsBuf[currRow:currRow + nRows, 1] = interval[2]
+            self._resultsBuf[currRow:currRow + nRows, 2:2 + nVars] = yMat.T
+            if fuseTumourSizeB:
+                self._resultsBuf[currRow:currRow + nRows, -1] = theta * np.sum(yMat, axis=0)
+            currRow += nRows
+            currStateVec[:] = solObj.y[:, -1]
         # If the solver diverges in the first interval, it can't return any solution. Catch this here, and in this case
         # replace the solution with all zeros.
-        if len(resultsDFList) > 0:
-            resultsDf = pd.concat(resultsDFList)
-        else:
-            resultsDf = pd.DataFrame({"Time": tVec, "DrugConcentration": np.zeros_like(tVec),
-                                     **dict(zip(self.stateVars,np.zeros_like(tVec)))})
+        if encounteredProblemB and currRow == startRow:
+            nRows = len(tVec)
+            self._resultsBuf[currRow:currRow + nRows, 0] = tVec
+            self._resultsBuf[currRow:currRow + nRows, 1:] = 0
+            currRow += nRows
         # Compute the fluorescent area that we'll see
-        resultsDf['TumourSize'] = pd.Series(self.RunCellCountToTumourSizeModel(resultsDf),
-                                            index=resultsDf.index)
-        if self.resultsDf is not None:
-            resultsDf = pd.concat([self.resultsDf, resultsDf])
-        self.resultsDf = resultsDf
+        if not fuseTumourSizeB:
+            newResultsDf = pd.DataFrame(self._resultsBuf[startRow:currRow, 2:2 + nVars], columns=self.stateVars)
+            self._resultsBuf[startRow:currRow, -1] = self.RunCellCountToTumourSizeModel(newResultsDf)
+        self._nResults = currRow
+        self._resultsDf = None  # Rebuilt from the buffer when next accessed
+        # Final state, for the adaptive therapy loops to check without going through resultsDf
+        self._lastStateVec = self._resultsBuf[currRow - 1, 2:2 + nVars].copy()
+        self._lastTumourSize = float(self._resultsBuf[currRow - 1, -1])
         self.successB = True if not encounteredProblemB else False
+        newResultsMat = self._resultsBuf[startRow:currRow]
+        return newResultsMat[:, 0], newResultsMat[:, 1], newResultsMat[:, 2:2 + nVars].T
+
+    # =========================================================================================
+    # Simulate a batch of trajectories which follow the same treatment schedule but start from
+    # different initial conditions. The trajectories are stacked into one state vector, so that
+    # each interval takes a single solver call, rather than one call per trajectory. If a compiled
+    # sweep solver is available for the method, the trajectories are instead solved separately, in
+    # parallel threads. With method='expm', each trajectory is solved in closed form, as in Simulate.
+    def SimulateBatch(self, treatmentScheduleList, initialStateMat, dtype=np.float64, **kwargs):
+        '''
+        Simulate a batch of trajectories, which are solved together.
+        treatmentScheduleList: List of treatment intervals, shared by all trajectories
+        initialStateMat: Array of shape (nTrajectories, nStateVars) with the initial conditions
+        dtype: Floating point type in which to store the results. np.float32 halves the memory
+               needed for large batches; the integration itself, and the state carried between
+               intervals, are always in double precision.
+        kwargs: Solver configuration, as for Simulate
+        Results are stored in long format in self.batchResultsDf, with a 'TrajectoryId' column.
+        '''
+        self._ConfigureSolver(**kwargs)
+        self.successB = False
+        if self._ParamsChangedB(): self._RefreshParams()
+        initialStateMat = np.atleast_2d(np.asarray(initialStateMat, dtype=float))
+        nTrajectories = initialStateMat.shape[0]
+        nVars = len(self.stateVars)
+        nSolverVars = nVars + 1 if self._drugInStateB else nVars  # Variables per trajectory passed to ModelEqns
+        currStateMat = initialStateMat.T.copy()
+
+        # The solver works on the flattened (nSolverVars*nTrajectories,) state, or on (nSolverVars*nTrajectories, k)
+        # when it evaluates several states at once to estimate the Jacobian.
+        # For a vectorised ModelEqns, both are passed as a (nSolverVars, nTrajectories*k) array of states.
+        if self._vectorizedB:
+            def batchEqns(t, y):
+                return self.ModelEqns(t, y.reshape(nSolverVars, -1)).reshape(y.shape)
+        else:
+            def batchEqns(t, y):
+                yMat = y.reshape(nSolverVars, nTrajectories)
+                return np.stack([self.ModelEqns(t, yMat[:, i]) for i in range(nTrajectories)], axis=1).ravel()
+
+        # The trajectories are independent, so the Jacobian of the stacked system is block-structured,
+        # and BDF and Radau can estimate it with as many evaluations as for a single trajectory
+        solverOptions = {}
+        if self.solverMethod in ('BDF', 'Radau'):
+            sparsityMat = self.JacobianSparsity()
+            sparsityMat = np.ones((nSolverVars, nSolverVars), dtype=bool) if sparsityMat is None else sparsityMat
+            solverOptions['jac_sparsity'] = scipy.sparse.kron(sparsityMat, scipy.sparse.identity(nTrajectories),
+                                                              format='csc')
+
+        tList, drugList, yList = [], [], []
+        encounteredProblemB = False
+        for tVec, interval in zip(self._IntervalTimes(treatmentScheduleList), treatmentScheduleList):
+            self.SetDrugConcentration(interval[2])
+            if self.solverMethod == 'expm':
+                yArr = np.stack([self.SolveIntervalExact(tVec, currStateMat[:, i]) for i in range(nTrajectories)], axis=1)
+                solObj = scipy.optimize.OptimizeResult(t=tVec, y=yArr.reshape(nVars * nTrajectories, -1), nfev=0, njev=0, nlu=0,
+                                                       status=0, message="Solved exactly using the matrix exponential.", success=True)
+            elif self.useNumbaB and self._compiledRhs is not None and self.solverMethod in self._compiledSweepMethods:
+                # Solve the trajectories independently, in parallel, in compiled code
+                yArr = np.empty((nTrajectories, nVars, len(tVec)))
+                statusVec, nfev = self._compiledSweepMethods[self.solverMethod](
+                    self._compiledRhs, float(tVec[0]), float(tVec[-1] + self.dt),
+                    np.ascontiguousarray(currStateMat.T), tVec, np.full(nTrajectories, self.drugConcentration), self._SolverParams(),
+                    float(self.absErr), float(self.relErr), float(self.max_step), yArr)
+                status = statusVec.min()
+                message = ("The solver successfully reached the end of the integration interval." if status == odeSolvers.SUCCESS
+                           else "Required step size is less than spacing between numbers.")
+                solObj = scipy.optimize.OptimizeResult(t=tVec, y=yArr.transpose(1, 0, 2).reshape(nVars * nTrajectories, -1),
+                                                       nfev=nfev, njev=0, nlu=0,
+                                                       status=status, message=message, success=status >= 0)
+            else:
+                y0Mat = (np.vstack((currStateMat, np.full((1, nTrajectories), self.drugConcentration)))
+                         if self._drugInStateB else currStateMat)
+                with self._SuppressSolverOutput():
+                    solObj = scipy.integrate.solve_ivp(batchEqns, y0=y0Mat.ravel(),
+                                                       t_span=(tVec[0], tVec[-1] + self.dt), t_eval=tVec,
+                                                       method=self.solverMethod,
+                                                       atol=self.absErr, rtol=self.relErr,
+                                                       max_step=self.max_step, vectorized=self._vectorizedB,
+                                                       **solverOptions)
+                if self._drugInStateB:
+                    solObj.y = solObj.y[:nVars * nTrajectories]
+            self.errMessage = ""
+            self.solObj = solObj
+            if not solObj.success:
+                encounteredProblemB = True
+                self.errMessage = solObj.message
+            elif np.any(solObj.y < 0):
+                self.errMessage = "Negative values encountered in the solution. Make the time step smaller or consider using a stiff solver."
+                if self.numericalStabilisationB:
+                    solObj.y[solObj.y < 0] = 0
+                    self.errMessage += "... Applying numerical stabilisation."
+                else:
+                    encounteredProblemB = True
+            if not self.suppressOutputB and len(self.errMessage) > 0:
+                print("xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
+                print(self.errMessage)
+                print("xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
+            if encounteredProblemB: break
+
+            yMat = solObj.y.reshape(nVars, nTrajectories, -1)
+            tList.append(tVec)
+            drugList.append(np.full_like(tVec, interval[2]))
+            yList.append(yMat.astype(dtype, copy=False))
+            currStateMat = yMat[:, :, -1].astype(float)
+
+        # Assemble the results in long format (trajectory-major)
+        if len(tList) > 0:
+            tVec = np.concatenate(tList)
+            drugConcentrationVec = np.concatenate(drugList)
+            yMat = np.concatenate(yList, axis=2)
+        else:
+            drugConcentrationVec = np.zeros_like(tVec)
+            yMat = np.zeros((nVars, nTrajectories, len(tVec)), dtype=dtype)
+        theta = self.paramDic.get('scaleFactor', 1)
+        self.batchResultsDf = pd.DataFrame({"TrajectoryId": np.repeat(np.arange(nTrajectories), len(tVec)),
+                                            "Time": np.tile(tVec, nTrajectories),
+                                            "DrugConcentration": np.tile(drugConcentrationVec, nTrajectories),
+                                            **{var: yMat[i].ravel() for i, var in enumerate(self.stateVars)},
+                                            "TumourSize": theta * yMat.sum(axis=0).ravel()})
+        self.successB = True if not encounteredProblemB else False
+
+    # =========================================================================================
+    # Run adaptive therapy (dose modulation strategy, as in Simulate_AT1) for a sweep of parameter
+    # sets, entirely in compiled code and in parallel across parameter sets. Only the state at the
+    # end of each interval is kept.
+    def SimulateSweep_AT1(self, paramDicList, initialStateMat=None, atThreshold=0.2, doseAdjustFac=0.5, D0=None,
+                          v_min=0, intervalLength=1., mode="original", t_end=1000, t_span=None, solver_kws={}):
+        '''
+        paramDicList: List of dictionaries with the parameters to update paramDic with for each simulation
+        initialStateMat: Array of shape (nSets, nStateVars) with the initial conditions (default: initialStateList for all)
+        The remaining arguments are as for Simulate_AT1. Each interval is solved up to the last
+        time point Simulate_AT1 would return for it (which can lie dt beyond its end), and
+        continued from there, so that the two take the same dose decisions.
+        The sweep requires Numba (with useNumbaB set), and one of the methods with a compiled
+        solver (self._compiledMethods: RK45, DOP853).
+        Results are stored in long format in self.sweepResultsDf, with a 'ParamSetId' column, and
+        the solver status (odeSolvers.SUCCESS or FAILED) of each set in self.sweepStatusVec.
+        '''
+        if self._compiledRhs is None:
+            raise ValueError("Simulate_AT1 sweeps require a model with a compiled right-hand side.")
+        self._ConfigureSolver(**solver_kws)
+        if not odeSolvers.NUMBA_AVAILABLE:
+            raise ValueError("Simulate_AT1 sweeps require Numba, which isn't installed.")
+        if not (self.useNumbaB and self.solverMethod in self._compiledMethods):
+            raise ValueError("Simulate_AT1 sweeps require Numba (useNumbaB=True) and one of the methods %s; got method '%s'."
+                             % (list(self._compiledMethods), self.solverMethod))
+        t_span = t_span if t_span is not None else (0, t_end)
+        nSets = len(paramDicList)
+        nVars = len(self.stateVars)
+        initialStateMat = np.tile(self.initialStateList, (nSets, 1)) if initialStateMat is None else initialStateMat
+        initialStateMat = np.ascontiguousarray(np.atleast_2d(initialStateMat), dtype=float)
+        if initialStateMat.shape != (nSets, nVars):
+            raise ValueError("initialStateMat must have shape (nSets, nStateVars) = (%d, %d); got %s."
+                             % (nSets, nVars, initialStateMat.shape))
+
+        # Parameters of each set, as cached by _RefreshParams
+        baseParamDic = self.paramDic
+        pMat, thetaVec, DMaxVec = np.empty((nSets, len(self._p))), np.empty(nSets), np.empty(nSets)
+        try:
+            for i, paramDic in enumerate(paramDicList):
+                self.paramDic = {**baseParamDic, **paramDic}
+                self._RefreshParams()
+                pMat[i] = self._p
+                thetaVec[i] = self.paramDic.get('scaleFactor', 1)
+                DMaxVec[i] = self.paramDic['DMax']
+        finally:
+            self.paramDic = baseParamDic
+            self._RefreshParams()
+        D0Vec = DMaxVec.copy() if D0 is None else np.full(nSets, float(D0))
+        if mode == "original": # Adjustment as proposed in Enriquez-Navas et al (2015)
+            doseReductionFac, doseIncreaseFac = 1 - doseAdjustFac, 1 + doseAdjustFac
+        else:
+            doseReductionFac, doseIncreaseFac = 1/doseAdjustFac, doseAdjustFac
+
+        # Same intervals, and time points at which the state is carried over, as in Simulate_AT1
+        tStartList, tEndList = [], []
+        currInterval = [t_span[0], t_span[0] + intervalLength]
+        with self._TimeGrid(t_span[0], t_end + intervalLength):
+            while currInterval[1] <= t_end + intervalLength:
+                tVec = self._GridTimes(currInterval)
+                tStartList.append(tVec[0])
+                tEndList.append(tVec[-1])
+                currInterval = [x + intervalLength for x in currInterval]
+        nIntervals = len(tStartList)
+
+        doseMat = np.full((nSets, nIntervals), np.nan)
+        yArr = np.full((nSets, nVars, nIntervals + 1), np.nan)
+        self.sweepStatusVec = np.full(nSets, odeSolvers.FAILED, dtype=np.int64)  # Set by at1_sweep for each set it solves
+        odeSolvers.at1_sweep(self._compiledRhs, self._compiledSolverParams, np.array(tStartList, dtype=float),
+                             np.array(tEndList, dtype=float), initialStateMat, pMat, thetaVec, D0Vec, DMaxVec,
+                             float(atThreshold), float(doseReductionFac), float(doseIncreaseFac), float(v_min),
+                             self.solverMethod == 'DOP853', float(self.absErr), float(self.relErr),
+                             float(self.max_step), doseMat, yArr, self.sweepStatusVec)
+
+        # Assemble the results in long format. The drug concentration at each time point is the
+        # dose in the interval that ends there (at the start, the first dose).
+        tVec = np.array([t_span[0]] + tEndList, dtype=float)
+        drugMat = np.concatenate((doseMat[:, :1], doseMat), axis=1)
+        self.sweepResultsDf = pd.DataFrame({"ParamSetId": np.repeat(np.arange(nSets), nIntervals + 1),
+                                            "Time": np.tile(tVec, nSets),
+                                            "DrugConcentration": drugMat.ravel(),
+                                            **{var: yArr[:, i].ravel() for i, var in enumerate(self.stateVars)},
+                                            "TumourSize": (thetaVec[:, None] * yArr.sum(axis=1)).ravel()})
+        self.successB = bool(np.all(self.sweepStatusVec == odeSolvers.SUCCESS))
 
     # =========================================================================================
     # Define the model mapping cell counts to observed fluorescent area
@@ -144,40 +732,43 @@ class ODEModel():
                      mode="original", t_end=1000, nCycles=np.inf, t_span=None, solver_kws={}):
         t_span = t_span if t_span is not None else (0, t_end)
         currInterval = [t_span[0], t_span[0] + intervalLength]
+        self._ConfigureSolver(**solver_kws)
+        if self._ParamsChangedB(): self._RefreshParams()
         refSize = self.paramDic.get('scaleFactor', 1) * np.sum(self.initialStateList)
-        dose = self.paramDic['DMax'] if D0 is None else D0
+        DMax = self.paramDic['DMax']
+        dose = DMax if D0 is None else D0
         lastNonZeroDose = dose # Remember the last non-zero dose if withdraw drug
+        # Factors by which the dose and the reference size are adjusted (fixed for the whole simulation)
+        if mode == "original": # Adjustment as proposed in Enriquez-Navas et al (2015)
+            doseReductionFac, doseIncreaseFac = 1 - doseAdjustFac, 1 + doseAdjustFac
+        else:
+            doseReductionFac, doseIncreaseFac = 1/doseAdjustFac, doseAdjustFac
+        shrinkageFac, growthFac = 1 - atThreshold, 1 + atThreshold
         currCycleId = 0
-        while (currInterval[1] <= t_end + intervalLength) and (currCycleId < nCycles):
-            # Simulate
-            # print(currInterval,refSize)
-            self.Simulate([[currInterval[0], currInterval[1], dose]], **solver_kws)
-
-            # Update dose
-            # print(self.resultsDf.TumourSize.iat[-1],(1+atThreshold)*refSize)
-            dose = lastNonZeroDose if dose == 0 else dose
-            if self.resultsDf.TumourSize.iat[-1] < v_min: # Withdraw treatment below a certain size
-                lastNonZeroDose = dose
-                dose = 0
-            elif self.resultsDf.TumourSize.iat[-1] < (1 - atThreshold) * refSize: # Reduce dose if sufficient shrinkage
-                if mode == "original":
-                    dose = max((1 - doseAdjustFac) * dose, 0) # Adjustment as proposed in Enriquez-Navas et al (2015)
-                else:
-                    dose = max(1/doseAdjustFac * dose, 0)
-            elif self.resultsDf.TumourSize.iat[-1] > (1 + atThreshold) * refSize: # Increase dose if excessive growth
-                if mode == "original":
-                    dose = min((1+doseAdjustFac) * dose, self.paramDic['DMax']) # Adjustment as proposed in Enriquez-Navas et al (2015)
-                else:
-                    dose = min(doseAdjustFac * dose, self.paramDic['DMax'])
-            else: # If size remains within a window of +- atThreshold, keep the same dose
-                dose = dose
+        with self._SuppressSolverOutput(), self._StiffnessSwitch(), self._TimeGrid(t_span[0], t_end + intervalLength), \
+                self._DoseRegimes(t_end + intervalLength + self.dt):
+            while (currInterval[1] <= t_end + intervalLength) and (currCycleId < nCycles):
+                # Simulate
+                # print(currInterval,refSize)
+                self._SimulateCore([[currInterval[0], currInterval[1], dose]], tVecList=[self._GridTimes(currInterval)])
 
-            # Update interval
-            refSize = self.resultsDf.TumourSize.iloc[-1]
-            currInterval = [x + intervalLength for x in currInterval]
+                # Update dose
+                # print(self._lastTumourSize,growthFac*refSize)
+                currSize = self._lastTumourSize
+                dose = lastNonZeroDose if dose == 0 else dose
+                if currSize < v_min: # Withdraw treatment below a certain size
+                    lastNonZeroDose = dose
+                    dose = 0
+                elif currSize < shrinkageFac * refSize: # Reduce dose if sufficient shrinkage
+                    dose = max(doseReductionFac * dose, 0)
+                elif currSize > growthFac * refSize: # Increase dose if excessive growth
+                    dose = min(doseIncreaseFac * dose, DMax)
+                else: # If size remains within a window of +- atThreshold, keep the same dose
+                    dose = dose
 
-        # Clean up the data frame
-        self.resultsDf.drop_duplicates(inplace=True)
+                # Update interval
+                refSize = currSize
+                currInterval = [x + intervalLength for x in currInterval]
 
     # =========================================================================================
     # Simulate adaptive therapy (dose skipping strategy)
@@ -185,36 +776,37 @@ class ODEModel():
                      nCycles=np.inf, t_span=None, solver_kws={}):
         t_span = t_span if t_span is not None else (0, t_end)
         currInterval = [t_span[0], t_span[0] + intervalLength]
+        self._ConfigureSolver(**solver_kws)
+        if self._ParamsChangedB(): self._RefreshParams()
         refSize = self.paramDic.get('scaleFactor', 1) * np.sum(self.initialStateList)
         prevSizesList = [refSize]*n_days_lookback
         dose = self.paramDic['DMax'] if D0 is None else D0
         D_star = self.paramDic['DMax'] if D_star is None else D_star
         currCycleId = 0
-        while (currInterval[1] <= t_end + intervalLength) and (currCycleId < nCycles):
-            # Simulate
-            # print(currInterval,refSize)
-            self.Simulate([[currInterval[0], currInterval[1], dose]], **solver_kws)
-
-            # Update dose
-            if self.resultsDf.TumourSize.iat[-1] > (1 + atThreshold) * refSize:  # Treat if excessive growth
-                dose = D_star #min(D_star, self.paramDic['DMax'])
-            else:  # Otherwise treat at minimum dose (=0 in Enriquez-Navas et al)
-                dose = DMin
-
-            # Update interval
-            refSize = prevSizesList[0]
-            prevSizesList[:-1] = prevSizesList[1:]
-            prevSizesList[-1] = self.resultsDf.TumourSize.iloc[-1] # AT2 uses the 2 time steps to decide dose
-            # print(prevSizesList, refSize, dose)
-            # currSize = self.resultsDf.TumourSize.iloc[-1] # AT2 uses the 2 time steps to decide dose
-            # refSize = prevSize if currCycleId!=0 else refSize # For the initial step
-            # prevSize = currSize
-            # print(currSize,refSize, dose)
-            currInterval = [x + intervalLength for x in currInterval]
-            currCycleId += 1
-
-        # Clean up the data frame
-        self.resultsDf.drop_duplicates(inplace=True)
+        with self._SuppressSolverOutput(), self._StiffnessSwitch(), self._TimeGrid(t_span[0], t_end + intervalLength), \
+                self._DoseRegimes(t_end + intervalLength + self.dt):
+            while (currInterval[1] <= t_end + intervalLength) and (currCycleId < nCycles):
+                # Simulate
+                # print(currInterval,refSize)
+                self._SimulateCore([[currInterval[0], currInterval[1], dose]], tVecList=[self._GridTimes(currInterval)])
+
+                # Update dose
+                if self._lastTumourSize > (1 + atThreshold) * refSize:  # Treat if excessive growth
+                    dose = D_star #min(D_star, self.paramDic['DMax'])
+                else:  # Otherwise treat at minimum dose (=0 in Enriquez-Navas et al)
+                    dose = DMin
+
+                # Update interval
+                refSize = prevSizesList[0]
+                prevSizesList[:-1] = prevSizesList[1:]
+                prevSizesList[-1] = self._lastTumourSize # AT2 uses the 2 time steps to decide dose
+                # print(prevSizesList, refSize, dose)
+                # currSize = self._lastTumourSize # AT2 uses the 2 time steps to decide dose
+                # refSize = prevSize if currCycleId!=0 else refSize # For the initial step
+                # prevSize = currSize
+                # print(currSize,refSize, dose)
+                currInterval = [x + intervalLength for x in currInterval]
+                currCycleId += 1
 
     # =========================================================================================
     # Simulate adaptive therapy (Zhang et al algorithm)
@@ -225,35 +817,36 @@ class ODEModel():
         intervalLength = intervalLength_on
         t_span = t_span if t_span is not None else (0, t_end)
         currInterval = [t_span[0], t_span[0] + intervalLength]
+        self._ConfigureSolver(**solver_kws)
+        if self._ParamsChangedB(): self._RefreshParams()
         refSize = self.paramDic.get('scaleFactor', 1) * np.sum(
             self.initialStateList) if refSize is None else refSize
         dose = self.paramDic['DMax']
         D_Star = self.paramDic['DMax'] if D_Star is None else D_Star
         currCycleId = 0
-        while (currInterval[1] <= t_end + intervalLength) and (currCycleId < nCycles):
-            # Simulate
-            # print(currInterval,refSize)
-            self.Simulate([[currInterval[0], currInterval[1], dose]], **solver_kws)
-
-            # Update dose
-            # print(self.resultsDf.TumourSize.iat[-1],(1-atThreshold)*refSize)
-            if self.resultsDf.TumourSize.iat[-1] < (
-                    1 - atThreshold) * refSize:  # Withdraw treatment below a certain size
-                dose = D_min
-                intervalLength = intervalLength_off
-            elif self.resultsDf.TumourSize.iat[-1] > refSize:
-                dose = D_Star
-                intervalLength = intervalLength_on
-            else:  # If size remains within a window of +- atThreshold, keep the same dose
-                dose = dose
-            # print(dose, intervalLength)
-
-            # Update interval
-            currInterval = [x + intervalLength for x in currInterval]
-            currCycleId += 1
-
-        # Clean up the data frame
-        self.resultsDf.drop_duplicates(inplace=True)
+        with self._SuppressSolverOutput(), self._StiffnessSwitch(), self._TimeGrid(t_span[0], t_end + max(intervalLength_on, intervalLength_off)), \
+                self._DoseRegimes(t_end + max(intervalLength_on, intervalLength_off) + self.dt):
+            while (currInterval[1] <= t_end + intervalLength) and (currCycleId < nCycles):
+                # Simulate
+                # print(currInterval,refSize)
+                self._SimulateCore([[currInterval[0], currInterval[1], dose]], tVecList=[self._GridTimes(currInterval)])
+
+                # Update dose
+                # print(self._lastTumourSize,(1-atThreshold)*refSize)
+                if self._lastTumourSize < (
+                        1 - atThreshold) * refSize:  # Withdraw treatment below a certain size
+                    dose = D_min
+                    intervalLength = intervalLength_off
+                elif self._lastTumourSize > refSize:
+                    dose = D_Star
+                    intervalLength = intervalLength_on
+                else:  # If size remains within a window of +- atThreshold, keep the same dose
+                    dose = dose
+                # print(dose, intervalLength)
+
+                # Update interval
+                currInterval = [x + intervalLength for x in currInterval]
+                currCycleId += 1
 
     # =========================================================================================
     # Simulate a long term assay, where we passage the cells at every interval
@@ -266,26 +859,27 @@ class ODEModel():
         solver_kws: Keyword arguments to pass to the solver
         '''
         # Initialise the model
-        for cycle_id, cycle in enumerate(treatment_schedule):
-            # Seed the cells
-            if cycle_id > 0:
-                # Read out the current seeding density
-                if type(seeding_density) is not list or len(seeding_density) == 1:
-                    # If a single value is given, assume that the seeding density is constant
-                    curr_seeding_density = seeding_density
+        self._ConfigureSolver(**solver_kws)
+        with self._SuppressSolverOutput(), self._StiffnessSwitch():
+            for cycle_id, cycle in enumerate(treatment_schedule):
+                # Seed the cells
+                if cycle_id > 0:
+                    # Read out the current seeding density
+                    if type(seeding_density) is not list or len(seeding_density) == 1:
+                        # If a single value is given, assume that the seeding density is constant
+                        curr_seeding_density = seeding_density
+                    else:
+                        # Otherwise, assume that the seeding density is given as a list of values
+                        curr_seeding_density = seeding_density[cycle_id]
+                    curr_resistance_fraction = self._lastStateVec[self.stateVars.index('R')]/self._lastTumourSize
+                    seededStateDic = {'S': curr_seeding_density * (1-curr_resistance_fraction),
+                                      'R': curr_seeding_density * curr_resistance_fraction}
                 else:
-                    # Otherwise, assume that the seeding density is given as a list of values
-                    curr_seeding_density = seeding_density[cycle_id]
-                curr_resistance_fraction = self.resultsDf['R'].iloc[-1]/self.resultsDf['TumourSize'].iloc[-1]
-                self.resultsDf['S'].iloc[-1] = curr_seeding_density * (1-curr_resistance_fraction)
-                self.resultsDf['R'].iloc[-1] = curr_seeding_density * curr_resistance_fraction
-                self.resultsDf['TumourSize'].iloc[-1] = self.resultsDf['S'].iloc[-1] + self.resultsDf['R'].iloc[-1]
+                    seededStateDic = None
 
-            # Simulate the current cycle
-            self.Simulate([cycle], **solver_kws)
-
-        # Clean up the data frame
-        self.resultsDf.drop_duplicates(inplace=True)
+                # Simulate the current cycle
+                self.Simulate([cycle], initialStateVec=None if seededStateDic is None else [seededStateDic[var] for var in self.stateVars],
+                              **solver_kws)
 
     # =========================================================================================
     # Simulate a long term assay, where we passage the cells at every interval
@@ -299,41 +893,46 @@ class ODEModel():
         '''
         # Initialise the model
         previous_cycle_on_drug = False
-        for cycle_id, cycle in enumerate(treatment_schedule):
-            # Seed the cells
-            if cycle_id > 0:
-                # Read out the current seeding density
-                if type(seeding_density) is not list or len(seeding_density) == 1:
-                    # If a single value is given, assume that the seeding density is constant
-                    curr_seeding_density = seeding_density
+        self._ConfigureSolver(**solver_kws)
+        with self._SuppressSolverOutput(), self._StiffnessSwitch():
+            for cycle_id, cycle in enumerate(treatment_schedule):
+                # Seed the cells
+                if cycle_id > 0:
+                    # Read out the current seeding density
+                    if type(seeding_density) is not list or len(seeding_density) == 1:
+                        # If a single value is given, assume that the seeding density is constant
+                        curr_seeding_density = seeding_density
+                    else:
+                        # Otherwise, assume that the seeding density is given as a list of values
+                        curr_seeding_density = seeding_density[cycle_id]
+                    curr_resistance_fraction = self._lastStateVec[self.stateVars.index('R')]/self._lastTumourSize
+                    seededStateDic = {'S': curr_seeding_density * (1-curr_resistance_fraction),
+                                      'R': curr_seeding_density * curr_resistance_fraction}
+                    if previous_cycle_on_drug: # Add additional kill from passaging
+                        seededStateDic['S'] *= (1-passaging_loss)
                 else:
-                    # Otherwise, assume that the seeding density is given as a list of values
-                    curr_seeding_density = seeding_density[cycle_id]
-                curr_resistance_fraction = self.resultsDf['R'].iloc[-1]/self.resultsDf['TumourSize'].iloc[-1]
-                self.resultsDf['S'].iloc[-1] = curr_seeding_density * (1-curr_resistance_fraction)
-                if previous_cycle_on_drug: # Add additional kill from passaging
-                    self.resultsDf['S'].iloc[-1] *= (1-passaging_loss)
-                self.resultsDf['R'].iloc[-1] = curr_seeding_density * curr_resistance_fraction
-                self.resultsDf['TumourSize'].iloc[-1] = self.resultsDf['S'].iloc[-1] + self.resultsDf['R'].iloc[-1]
-
-            # Simulate the current cycle
-            self.Simulate([cycle], **solver_kws)
-            previous_cycle_on_drug = cycle[-1] > 0
-
-        # Clean up the data frame
-        self.resultsDf.drop_duplicates(inplace=True)
+                    seededStateDic = None
+
+                # Simulate the current cycle
+                self.Simulate([cycle], initialStateVec=None if seededStateDic is None else [seededStateDic[var] for var in self.stateVars],
+                              **solver_kws)
+                previous_cycle_on_drug = cycle[-1] > 0
 
     # =========================================================================================
     # Interpolate to specific time resolution (e.g. for plotting)
     def Trim(self, t_eval=None, dt=1):
-        t_eval = np.arange(0, self.resultsDf.Time.max(), dt) if t_eval is None else t_eval
-        tmpDfList = []
-        trimmedResultsDic = {'Time': t_eval}
-        for variable in [*self.stateVars, 'TumourSize', 'DrugConcentration']:
-            f = scipy.interpolate.interp1d(self.resultsDf.Time, self.resultsDf[variable])
-            trimmedResultsDic = {**trimmedResultsDic, variable: f(t_eval)}
-        tmpDfList.append(pd.DataFrame(trimmedResultsDic))
-        self.resultsDf = pd.concat(tmpDfList)
+        t_eval = np.arange(0, self.resultsDf.Time.max(), dt) if t_eval is None else np.asarray(t_eval, dtype=float)
+        # Linear interpolation with np.interp, which is what scipy.interpolate.interp1d (used
+        # previously) calls for this. The times are read, and sorted if needed, only once.
+        tVec = self.resultsDf['Time'].to_numpy(dtype=float)
+        sortIdx = np.argsort(tVec, kind="mergesort") if np.any(np.diff(tVec) < 0) else slice(None)
+        tVec = tVec[sortIdx]
+        if np.any(t_eval < tVec[0]) or np.any(t_eval > tVec[-1]):
+            raise ValueError("Time points in t_eval lie outside of the simulated time range (%g, %g)." % (tVec[0], tVec[-1]))
+        self.resultsDf = pd.DataFrame({'Time': t_eval,
+                                       **{variable: np.interp(t_eval, tVec, self.resultsDf[variable].to_numpy(dtype=float)[sortIdx]).astype(self.storePrecision)
+                                          for variable in [*self.stateVars, 'TumourSize']},
+                                       'DrugConcentration': np.interp(t_eval, tVec, self.resultsDf['DrugConcentration'].to_numpy(dtype=float)[sortIdx])})
 
     # =========================================================================================
     # Function to plot the model predictions
@@ -341,17 +940,30 @@ class ODEModel():
              xmin=0, xlim=None, ymin=0, ylim=None, y2lim=1, palette=None,
              decorateAxes=True, legend=False,
              drugBarPosition=0.85, drugBarColour="black", 
-             decoratey2=True, ax=None, **kwargs):
+             decoratey2=True, ax=None, style="matplotlib", **kwargs):
         if ax is None: fig, ax = plt.subplots(1, 1)
         varsToPlotList = ["TumourSize"]
         if plotPops: varsToPlotList += self.stateVars
-        currModelPredictionDf = pd.melt(self.resultsDf, id_vars=['Time'], value_vars=varsToPlotList)
 
         # 1. Plot the model predictions
-        sns.lineplot(x="Time", y="value", hue="variable", style="variable", n_boot=n_boot,
-                     lw=5, palette=palette,
-                     legend=legend,
-                     data=currModelPredictionDf, ax=ax)
+        if style == "seaborn":
+            currModelPredictionDf = pd.melt(self.resultsDf, id_vars=['Time'], value_vars=varsToPlotList)
+            sns.lineplot(x="Time", y="value", hue="variable", style="variable", n_boot=n_boot,
+                         lw=5, palette=palette,
+                         legend=legend,
+                         data=currModelPredictionDf, ax=ax)
+        else:
+            # Plot the columns directly, which is much faster for long simulations. Colours and
+            # dashes are chosen as seaborn would.
+            colourList = ([palette[variable] for variable in varsToPlotList] if isinstance(palette, dict)
+                          else sns.color_palette(palette, len(varsToPlotList)))
+            dashesList = ["", (4, 1.5), (1, 1), (3, 1.25, 1.5, 1.25), (5, 1, 1, 1)]
+            timeVec = self.resultsDf['Time'].to_numpy()
+            for i, variable in enumerate(varsToPlotList):
+                dashes = dashesList[i % len(dashesList)]
+                ax.plot(timeVec, self.resultsDf[variable].to_numpy(), lw=5, color=colourList[i], label=variable,
+                        **({'dashes': dashes} if dashes else {}))
+            if legend: ax.legend()
 
         # 2. Add the drug bars
         ax2 = ax.twinx()  # instantiate a second axis that shares the same x-axis
@@ -361,9 +973,8 @@ class ODEModel():
                                                     treatmentColumn="DrugConcentration",
                                                     mode="post"),
             tVec=drug_data_df["Time"])
-        drugConcentrationVec[drugConcentrationVec < 0] = 0
-        drugConcentrationVec = np.array([x / (np.max(drugConcentrationVec) + 1e-12) for x in drugConcentrationVec])
-        drugConcentrationVec = drugConcentrationVec / (1 - drugBarPosition) + drugBarPosition
+        drugConcentrationVec = np.maximum(drugConcentrationVec, 0)
+        drugConcentrationVec = drugConcentrationVec / ((drugConcentrationVec.max() + 1e-12) * (1 - drugBarPosition)) + drugBarPosition
         ax2.fill_between(drug_data_df["Time"], drugBarPosition, drugConcentrationVec,
                         step="post", color=drugBarColour, alpha=1., label="Drug Concentration")
         ax2.axis("off")
@@ -381,6 +992,34 @@ class ODEModel():
             plt.savefig(kwargs.get('outName', 'modelPrediction.png'), orientation='portrait', format='png')
             plt.close()
 
+# ====================================================================================
+# Run an adaptive therapy simulation (any of the Simulate_AT* functions) for each of a list of
+# parameter sets. The simulations are independent of each other, so they are distributed over
+# the available cores with joblib, if it's installed.
+# modelClass: Model to simulate (e.g. EinarPersistorModelType3L)
+# paramDicList: List of dictionaries with the parameters to update model.paramDic with
+# initialStateList: Initial state of the simulations
+# atMethod: Name of the adaptive therapy function to run
+# n_jobs: Number of processes to use (-1: all cores)
+# model_kws: Keyword arguments passed to the model's constructor
+# kwargs: Keyword arguments passed to the adaptive therapy function
+# Returns the resultsDf of each simulation, in the order of paramDicList.
+def run_at_sweep(modelClass, paramDicList, initialStateList, atMethod="Simulate_AT1", n_jobs=-1,
+                 model_kws={}, **kwargs):
+    if not JOBLIB_AVAILABLE or n_jobs == 1:
+        return [_run_at(modelClass, paramDic, initialStateList, atMethod, model_kws, kwargs)
+                for paramDic in paramDicList]
+    return joblib.Parallel(n_jobs=n_jobs, backend='loky')(
+        joblib.delayed(_run_at)(modelClass, paramDic, initialStateList, atMethod, model_kws, kwargs)
+        for paramDic in paramDicList)
+
+def _run_at(modelClass, paramDic, initialStateList, atMethod, model_kws, at_kws):
+    model = modelClass(**model_kws)
+    model.paramDic.update(paramDic)
+    model.initialStateList = list(initialStateList)
+    getattr(model, atMethod)(**at_kws)
+    return model.resultsDf
+
 # ====================================================================================
 # Functions used to suppress output from odeint
 # Taken from: https://stackoverflow.com/questions/31681946/disable-warnings-originating-from-scipy
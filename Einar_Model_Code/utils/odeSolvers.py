@@ -0,0 +1,543 @@
+# ====================================================================================
+# ODE solvers compiled with Numba
+# ====================================================================================
+# These bypass scipy.integrate.solve_ivp for models which provide a compiled right-hand
+# side, so that the whole integration runs without calling back into Python (scipy's
+# solve_ivp and odeint only take Python callables for the right-hand side; unlike e.g.
+# scipy.integrate.quad, they don't accept a scipy.LowLevelCallable). The
+# right-hand side is passed in as a Numba-compiled function with the signature
+#   rhs(t, y, cfrac, p, dydt)
+# which writes the derivatives of the state y into dydt. The drug level, cfrac, is
+# constant over a treatment interval and so is passed as a parameter rather than being
+# carried in the state. p is the tuple of model parameters (ODEModel._p).
+# The solvers are compiled for a fixed type of right-hand side (RHS_SIGNATURE), so that
+# the rhs is passed in as a function pointer. This allows Numba to cache the compiled
+# solvers on disk (it can't if they are specialised on the individual rhs).
+# Numba is optional. Without it, the functions decorated with njit here and in CustomModel
+# run as plain Python, and ODEModel uses scipy's solvers for all methods (see NUMBA_AVAILABLE).
+import functools
+import numpy as np
+from scipy.integrate._ivp import dop853_coefficients
+try:
+    from numba import njit, prange, types, typeof
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and len(kwargs) == 0:
+            return args[0]
+        return lambda func: func
+
+# Status codes (as in scipy.integrate.solve_ivp)
+SUCCESS = 0
+FAILED = -1
+
+# Signature of the compiled right-hand sides. The parameters are passed as a tuple of fixed
+# length, RHS_N_PARAMS, so that the solvers can be compiled (and cached) once for all models.
+# This is the number of parameters of the Einar models, the only ones with a compiled rhs so far;
+# they pass the 4 entries of their rate matrix, padded with zeros (see CustomModel). A model
+# with more parameters would need RHS_N_PARAMS raised (and the solvers recompiled).
+RHS_N_PARAMS = 8
+if NUMBA_AVAILABLE:
+    RHS_SIGNATURE = types.void(types.float64, types.float64[::1], types.float64,
+                               types.UniTuple(types.float64, RHS_N_PARAMS), types.float64[::1])
+    _rhsType = types.FunctionType(RHS_SIGNATURE)
+    _solverSignature = (_rhsType, types.float64, types.float64, types.float64[::1], types.float64[::1],
+                      types.float64, types.UniTuple(types.float64, RHS_N_PARAMS), types.float64, types.float64,
+                      types.float64, types.float64)
+    _sweepArgs = (_rhsType, types.float64, types.float64, types.float64[:, ::1], types.float64[::1],
+                  types.float64[::1], types.UniTuple(types.float64, RHS_N_PARAMS), types.float64, types.float64, types.float64)
+    _sweepSignatures = [_sweepArgs + (types.float64[:, :, ::1],), _sweepArgs + (types.float32[:, :, ::1],)]
+    # Functions mapping the drug level and model parameters (ODEModel._p, as an array) to the
+    # parameters passed to the rhs over an interval (the compiled counterpart of ODEModel._SolverParams)
+    PARAMS_SIGNATURE = types.UniTuple(types.float64, RHS_N_PARAMS)(types.float64, types.float64[::1])
+    _paramsType = types.FunctionType(PARAMS_SIGNATURE)
+    _atSweepSignature = types.void(_rhsType, _paramsType, types.float64[::1], types.float64[::1],
+                                   types.float64[:, ::1], types.float64[:, ::1], types.float64[::1],
+                                   types.float64[::1], types.float64[::1], types.float64, types.float64,
+                                   types.float64, types.float64, types.boolean, types.float64, types.float64,
+                                   types.float64, types.float64[:, ::1], types.float64[:, :, ::1], types.int64[::1])
+else:
+    RHS_SIGNATURE = _solverSignature = _sweepSignatures = PARAMS_SIGNATURE = _atSweepSignature = None
+
+# The parallel sweeps take long to compile and only some analyses use them, so unlike the
+# solvers they aren't compiled on import. njit_on_first_call compiles (or loads from Numba's
+# cache) the signature matching the arguments the first time it's called with them. Otherwise
+# compilation stays disabled, so that compiled functions passed in (e.g. the rhs) are converted
+# to the function types of the signature, rather than each triggering a new compilation that
+# can't be cached.
+def njit_on_first_call(signatures, **kwargs):
+    def decorator(func):
+        if not NUMBA_AVAILABLE:
+            return func
+        dispatcher = njit(**kwargs)(func)
+        argTypesList = [tuple(getattr(signature, 'args', signature)) for signature in signatures]
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            if len(dispatcher.signatures) < len(argTypesList):
+                callTypes = [typeof(arg) for arg in args]
+                matchList = [argTypes for argTypes in argTypesList
+                             if len(argTypes) == len(callTypes) and all(
+                                 isinstance(argType, types.FunctionType) or argType == callType
+                                 for argType, callType in zip(argTypes, callTypes))]
+                if len(matchList) == 0:
+                    raise TypeError("No matching signature of %s for argument types %s" % (func.__name__, callTypes))
+                if matchList[0] not in dispatcher.signatures:
+                    dispatcher.disable_compile(False)
+                    dispatcher.compile(matchList[0])
+                    dispatcher.disable_compile()
+            return dispatcher(*args)
+        return wrapper
+    return decorator
+
+# ====================================================================================
+# Dormand-Prince 5(4) coefficients, as used by scipy.integrate.RK45 (including its
+# quartic interpolant for dense output), so that results match those of scipy.
+RK45_C = np.array([0, 1/5, 3/10, 4/5, 8/9, 1])
+RK45_A = np.array([
+    [0, 0, 0, 0, 0],
+    [1/5, 0, 0, 0, 0],
+    [3/40, 9/40, 0, 0, 0],
+    [44/45, -56/15, 32/9, 0, 0],
+    [19372/6561, -25360/2187, 64448/6561, -212/729, 0],
+    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]
+])
+RK45_B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+RK45_E = np.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40])
+RK45_P = np.array([
+    [1, -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+    [0, 0, 0, 0],
+    [0, 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+    [0, -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+    [0, 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+    [0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+    [0, 40617522/29380423, -110615467/29380423, 69997945/29380423]])
+
+# Coefficients of the explicit Runge-Kutta method of order 8(5,3) of Dormand & Prince, and of
+# its 7th order interpolant, taken from scipy.integrate.DOP853 so that results match those of scipy.
+DOP853_N_STAGES = dop853_coefficients.N_STAGES
+DOP853_N_STAGES_EXTENDED = dop853_coefficients.N_STAGES_EXTENDED  # Including the extra stages for dense output
+DOP853_A = dop853_coefficients.A
+DOP853_B = dop853_coefficients.B
+DOP853_C = dop853_coefficients.C
+DOP853_E3 = dop853_coefficients.E3
+DOP853_E5 = dop853_coefficients.E5
+DOP853_D = dop853_coefficients.D
+
+# Step size control (as in scipy.integrate.RK45 and DOP853)
+SAFETY = 0.9
+MIN_FACTOR = 0.2
+MAX_FACTOR = 10.
+
+# ====================================================================================
+@njit(cache=True)
+def _rms_norm(x):
+    return np.sqrt(np.mean(x * x))
+
+# Heuristic for the size of the first step (Hairer, Norsett & Wanner, Sec. II.4), as in scipy
+@njit(cache=True)
+def _select_initial_step(rhs, t0, y0, f0, t_bound, cfrac, p, order, atol, rtol, max_step):
+    interval_length = t_bound - t0
+    if interval_length == 0.:
+        return 0.
+    scale = atol + np.abs(y0) * rtol
+    d0 = _rms_norm(y0 / scale)
+    d1 = _rms_norm(f0 / scale)
+    if d0 < 1e-5 or d1 < 1e-5:
+        h0 = 1e-6
+    else:
+        h0 = 0.01 * d0 / d1
+    h0 = min(h0, interval_length)
+    y1 = y0 + h0 * f0
+    f1 = np.empty_like(y0)
+    rhs(t0 + h0, y1, cfrac, p, f1)
+    d2 = _rms_norm((f1 - f0) / scale) / h0
+    if d1 <= 1e-15 and d2 <= 1e-15:
+        h1 = max(1e-6, h0 * 1e-3)
+    else:
+        h1 = (0.01 / max(d1, d2)) ** (1. / (order + 1))
+    return min(100 * h0, h1, interval_length, max_step)
+
+# ====================================================================================
+@njit(_solverSignature, cache=True)
+def rk45(rhs, t0, t_bound, y0, t_eval, cfrac, p, atol, rtol, max_step, first_step):
+    '''
+    Integrate rhs from t0 to t_bound with the explicit Runge-Kutta method of order 5(4),
+    returning the solution at the (sorted) time points in t_eval.
+    first_step is the size of the first step to try. If <= 0, it is chosen automatically.
+    Returns (yMat, status, nfev, next_step), where yMat has shape (len(y0), len(t_eval)), and
+    next_step is the step size the solver would have tried next (ignoring the end of the
+    interval). When solving consecutive intervals, this can be passed in as first_step
+    for the next one, to save the solver from working its step size up from scratch.
+    '''
+    nVars = y0.shape[0]
+    nEval = t_eval.shape[0]
+    yMat = np.zeros((nVars, nEval))
+    K = np.empty((7, nVars))  # Stage derivatives. K[0] holds f(t, y) at the start of the step.
+    y = y0.copy()
+    yNew = np.empty(nVars)
+    yStage = np.empty(nVars)
+    error = np.empty(nVars)
+    Q = np.empty((nVars, 4))  # Coefficients of the interpolating polynomial
+    rhs(t0, y, cfrac, p, K[0])
+    nfev = 1
+    if first_step > 0:
+        h_abs = first_step
+    else:
+        h_abs = _select_initial_step(rhs, t0, y, K[0], t_bound, cfrac, p, 4, atol, rtol, max_step)
+        nfev += 1
+    next_step = h_abs
+    error_exponent = -1. / 5.
+
+    t = t0
+    evalId = 0
+    status = SUCCESS
+    while t < t_bound:
+        min_step = 10 * np.abs(np.nextafter(t, np.inf) - t)
+        if h_abs > max_step:
+            h_abs = max_step
+        elif h_abs < min_step:
+            h_abs = min_step
+
+        # Attempt steps until one meets the error tolerance
+        step_accepted = False
+        step_rejected = False
+        while not step_accepted:
+            if h_abs < min_step:
+                status = FAILED
+                break
+            t_new = min(t + h_abs, t_bound)
+            h = t_new - t
+            h_abs = h
+            for s in range(1, 6):
+                for i in range(nVars):
+                    dy = 0.
+                    for j in range(s):
+                        dy += RK45_A[s, j] * K[j, i]
+                    yStage[i] = y[i] + h * dy
+                rhs(t + RK45_C[s] * h, yStage, cfrac, p, K[s])
+            for i in range(nVars):
+                dy = 0.
+                for j in range(6):
+                    dy += RK45_B[j] * K[j, i]
+                yNew[i] = y[i] + h * dy
+            rhs(t_new, yNew, cfrac, p, K[6])
+            nfev += 6
+            for i in range(nVars):
+                err = 0.
+                for j in range(7):
+                    err += RK45_E[j] * K[j, i]
+                error[i] = h * err / (atol + max(np.abs(y[i]), np.abs(yNew[i])) * rtol)
+            error_norm = _rms_norm(error)
+
+            if error_norm < 1:
+                if error_norm == 0:
+                    factor = MAX_FACTOR
+                else:
+                    factor = min(MAX_FACTOR, SAFETY * error_norm ** error_exponent)
+                if step_rejected:
+                    factor = min(1., factor)
+                if t_new < t_bound:
+                    next_step = h_abs * factor
+                h_abs *= factor
+                step_accepted = True
+            else:
+                h_abs *= max(MIN_FACTOR, SAFETY * error_norm ** error_exponent)
+                step_rejected = True
+        if status != SUCCESS:
+            break
+
+        # Interpolate onto the requested time points covered by this step
+        if evalId < nEval and t_eval[evalId] <= t_new:
+            for i in range(nVars):
+                for k in range(4):
+                    q = 0.
+                    for j in range(7):
+                        q += K[j, i] * RK45_P[j, k]
+                    Q[i, k] = q
+            while evalId < nEval and t_eval[evalId] <= t_new:
+                x = (t_eval[evalId] - t) / h
+                xPow = x
+                for k in range(4):
+                    for i in range(nVars):
+                        yMat[i, evalId] += Q[i, k] * xPow
+                    xPow *= x
+                for i in range(nVars):
+                    yMat[i, evalId] = y[i] + h * yMat[i, evalId]
+                evalId += 1
+
+        t = t_new
+        y[:] = yNew
+        K[0] = K[6]
+    return yMat, status, nfev, next_step
+
+# ====================================================================================
+@njit(_solverSignature, cache=True)
+def dop853(rhs, t0, t_bound, y0, t_eval, cfrac, p, atol, rtol, max_step, first_step):
+    '''
+    Integrate rhs from t0 to t_bound with the explicit Runge-Kutta method of order 8 (as
+    scipy.integrate.DOP853), returning the solution at the (sorted) time points in t_eval.
+    Arguments and return values are as for rk45.
+    '''
+    nStages = DOP853_N_STAGES
+    nVars = y0.shape[0]
+    nEval = t_eval.shape[0]
+    yMat = np.zeros((nVars, nEval))
+    K = np.empty((DOP853_N_STAGES_EXTENDED, nVars))  # Stage derivatives. K[0] holds f(t, y) at the start of the step.
+    y = y0.copy()
+    yNew = np.empty(nVars)
+    yStage = np.empty(nVars)
+    F = np.empty((7, nVars))  # Coefficients of the interpolating polynomial
+    rhs(t0, y, cfrac, p, K[0])
+    nfev = 1
+    if first_step > 0:
+        h_abs = first_step
+    else:
+        h_abs = _select_initial_step(rhs, t0, y, K[0], t_bound, cfrac, p, 7, atol, rtol, max_step)
+        nfev += 1
+    next_step = h_abs
+    error_exponent = -1. / 8.
+
+    t = t0
+    evalId = 0
+    status = SUCCESS
+    while t < t_bound:
+        min_step = 10 * np.abs(np.nextafter(t, np.inf) - t)
+        if h_abs > max_step:
+            h_abs = max_step
+        elif h_abs < min_step:
+            h_abs = min_step
+
+        # Attempt steps until one meets the error tolerance
+        step_accepted = False
+        step_rejected = False
+        while not step_accepted:
+            if h_abs < min_step:
+                status = FAILED
+                break
+            t_new = min(t + h_abs, t_bound)
+            h = t_new - t
+            h_abs = h
+            for s in range(1, nStages):
+                for i in range(nVars):
+                    dy = 0.
+                    for j in range(s):
+                        dy += DOP853_A[s, j] * K[j, i]
+                    yStage[i] = y[i] + h * dy
+                rhs(t + DOP853_C[s] * h, yStage, cfrac, p, K[s])
+            for i in range(nVars):
+                dy = 0.
+                for j in range(nStages):
+                    dy += DOP853_B[j] * K[j, i]
+                yNew[i] = y[i] + h * dy
+            rhs(t_new, yNew, cfrac, p, K[nStages])
+            nfev += nStages
+
+            # Error estimate combining the 5th and 3rd order embedded methods
+            err5Norm2 = 0.
+            err3Norm2 = 0.
+            for i in range(nVars):
+                scale = atol + max(np.abs(y[i]), np.abs(yNew[i])) * rtol
+                err5 = 0.
+                err3 = 0.
+                for j in range(nStages + 1):
+                    err5 += DOP853_E5[j] * K[j, i]
+                    err3 += DOP853_E3[j] * K[j, i]
+                err5Norm2 += (err5 / scale) ** 2
+                err3Norm2 += (err3 / scale) ** 2
+            if err5Norm2 == 0 and err3Norm2 == 0:
+                error_norm = 0.
+            else:
+                error_norm = h * err5Norm2 / np.sqrt((err5Norm2 + 0.01 * err3Norm2) * nVars)
+
+            if error_norm < 1:
+                if error_norm == 0:
+                    factor = MAX_FACTOR
+                else:
+                    factor = min(MAX_FACTOR, SAFETY * error_norm ** error_exponent)
+                if step_rejected:
+                    factor = min(1., factor)
+                if t_new < t_bound:
+                    next_step = h_abs * factor
+                h_abs *= factor
+                step_accepted = True
+            else:
+                h_abs *= max(MIN_FACTOR, SAFETY * error_norm ** error_exponent)
+                step_rejected = True
+        if status != SUCCESS:
+            break
+
+        # Interpolate onto the requested time points covered by this step. This needs three
+        # more evaluations of the right-hand side.
+        if evalId < nEval and t_eval[evalId] <= t_new:
+            for s in range(nStages + 1, DOP853_N_STAGES_EXTENDED):
+                for i in range(nVars):
+                    dy = 0.
+                    for j in range(s):
+                        dy += DOP853_A[s, j] * K[j, i]
+                    yStage[i] = y[i] + h * dy
+                rhs(t + DOP853_C[s] * h, yStage, cfrac, p, K[s])
+            nfev += DOP853_N_STAGES_EXTENDED - nStages - 1
+            for i in range(nVars):
+                delta_y = yNew[i] - y[i]
+                F[0, i] = delta_y
+                F[1, i] = h * K[0, i] - delta_y
+                F[2, i] = 2 * delta_y - h * (K[nStages, i] + K[0, i])
+                for k in range(4):
+                    d = 0.
+                    for j in range(DOP853_N_STAGES_EXTENDED):
+                        d += DOP853_D[k, j] * K[j, i]
+                    F[3 + k, i] = h * d
+            while evalId < nEval and t_eval[evalId] <= t_new:
+                x = (t_eval[evalId] - t) / h
+                for i in range(nVars):
+                    yInterp = 0.
+                    for k in range(7):
+                        yInterp += F[6 - k, i]
+                        if k % 2 == 0:
+                            yInterp *= x
+                        else:
+                            yInterp *= 1 - x
+                    yMat[i, evalId] = y[i] + yInterp
+                evalId += 1
+
+        t = t_new
+        y[:] = yNew
+        K[0] = K[nStages]
+    return yMat, status, nfev, next_step
+
+# ====================================================================================
+@njit_on_first_call(_sweepSignatures, parallel=True, cache=True)
+def rk45_sweep(rhs, t0, t_bound, y0Mat, t_eval, cfracVec, p, atol, rtol, max_step, yArr):
+    '''
+    Solve a sweep of independent trajectories with rk45, in parallel across the available
+    threads (set NUMBA_NUM_THREADS to control how many). Trajectory i starts from y0Mat[i]
+    and is solved at the drug level cfracVec[i]. All share the model parameters p.
+    The solutions are written into yArr, of shape (nTrajectories, n_vars, len(t_eval)). This
+    can be single precision, to halve the memory needed for large sweeps; the integration
+    itself is always done in double precision.
+    Returns (statusVec, nfev).
+    '''
+    nTrajectories = y0Mat.shape[0]
+    statusVec = np.empty(nTrajectories, dtype=np.int64)
+    nfevVec = np.empty(nTrajectories, dtype=np.int64)
+    for i in prange(nTrajectories):
+        yMat, status, nfev, _ = rk45(rhs, t0, t_bound, y0Mat[i].copy(), t_eval, cfracVec[i], p,
+                                     atol, rtol, max_step, 0.)
+        yArr[i] = yMat
+        statusVec[i] = status
+        nfevVec[i] = nfev
+    return statusVec, nfevVec.sum()
+
+# ====================================================================================
+# Default for ODEModel._compiledSolverParams: the rhs takes the model parameters as they are
+@njit(PARAMS_SIGNATURE, cache=True)
+def model_params(cfrac, p):
+    return p[0], p[1], p[2], p[3], p[4], p[5], p[6], p[7]
+
+@njit_on_first_call([_atSweepSignature], parallel=True, cache=True)
+def at1_sweep(rhs, solverParams, tStartVec, tEndVec, y0Mat, pMat, thetaVec, D0Vec, DMaxVec,
+              atThreshold, doseReductionFac, doseIncreaseFac, v_min, dop853B, atol, rtol, max_step,
+              doseMat, yArr, statusVec):
+    '''
+    Run the dose modulation algorithm of ODEModel.Simulate_AT1 for a sweep of parameter sets,
+    in parallel across the available threads. Set i has the model parameters pMat[i] (as in
+    ODEModel._p), starts from y0Mat[i] at dose D0Vec[i], and its dose is capped at DMaxVec[i];
+    thetaVec[i] converts its cell counts into the tumour size. All of the arrays need to have a
+    row for each of the pMat.shape[0] sets; the caller checks this, as Numba doesn't.
+    Interval k is solved from tStartVec[k] to tEndVec[k], from the state at the end of the
+    previous one (these need not coincide; see ODEModel.SimulateSweep_AT1).
+    The dose in each of the nIntervals intervals is written into doseMat (nSets, nIntervals),
+    and the initial state and the state at the end of each interval into yArr (nSets, n_vars, nIntervals + 1).
+    statusVec[i] is FAILED if the solver failed, or the solution became negative, for set i;
+    its remaining entries in doseMat and yArr are then left as they are.
+    '''
+    nSets = pMat.shape[0]
+    nIntervals = tStartVec.shape[0]
+    for i in prange(nSets):
+        p = pMat[i]
+        y = y0Mat[i].copy()
+        yArr[i, :, 0] = y
+        tEval = np.empty(1)
+        refSize = thetaVec[i] * y.sum()
+        dose = D0Vec[i]
+        lastNonZeroDose = dose
+        prevDose = dose
+        step = 0.
+        statusVec[i] = SUCCESS
+        for k in range(nIntervals):
+            doseMat[i, k] = dose
+            if dose != prevDose:
+                step = 0.  # The dynamics change, so let the solver choose its step size afresh
+            t = tStartVec[k]
+            tEval[0] = tEndVec[k]
+            if dop853B:
+                yMat, status, nfev, step = dop853(rhs, t, tEval[0], y, tEval, dose, solverParams(dose, p),
+                                                  atol, rtol, max_step, step)
+            else:
+                yMat, status, nfev, step = rk45(rhs, t, tEval[0], y, tEval, dose, solverParams(dose, p),
+                                                atol, rtol, max_step, step)
+            y = yMat[:, 0].copy()
+            if status != SUCCESS or np.any(y < 0):
+                statusVec[i] = FAILED
+                break
+            yArr[i, :, k + 1] = y
+
+            # Update the dose, as in ODEModel.Simulate_AT1
+            currSize = thetaVec[i] * y.sum()
+            prevDose = dose
+            dose = lastNonZeroDose if dose == 0 else dose
+            if currSize < v_min:
+                lastNonZeroDose = dose
+                dose = 0.
+            elif currSize < (1 - atThreshold) * refSize:
+                dose = max(doseReductionFac * dose, 0.)
+            elif currSize > (1 + atThreshold) * refSize:
+                dose = min(doseIncreaseFac * dose, DMaxVec[i])
+            refSize = currSize
+
+# ====================================================================================
+@njit(cache=True)
+def expm_linear2(A, y0, t_eval):
+    '''
+    Exact solution of the linear system dy/dt = A y, with constant 2x2 matrix A, at the time
+    points in t_eval (starting from y(t_eval[0]) = y0). Uses the closed form of the matrix
+    exponential, expm(A*tau) = exp(s*tau) * (cosh(q*tau)*I + sinh(q*tau)/q * (A - s*I)), with
+    s = tr(A)/2 and q^2 = ((a - d)/2)^2 + b*c. For q^2 < 0 this becomes cos/sin.
+    Returns yMat of shape (2, len(t_eval)).
+    '''
+    s = 0.5 * (A[0, 0] + A[1, 1])
+    halfDiff = 0.5 * (A[0, 0] - A[1, 1])
+    qSq = halfDiff * halfDiff + A[0, 1] * A[1, 0]
+    q = np.sqrt(np.abs(qSq))
+    # w = (A - s*I) @ y0
+    w0 = halfDiff * y0[0] + A[0, 1] * y0[1]
+    w1 = A[1, 0] * y0[0] - halfDiff * y0[1]
+    nEval = t_eval.shape[0]
+    yMat = np.empty((2, nEval))
+    for i in range(nEval):
+        tau = t_eval[i] - t_eval[0]
+        qTau = q * tau
+        if qSq > 0 and qTau > 1e-3:
+            # Write cosh and sinh as exponentials, so that they can't overflow where
+            # exp(s*tau) would cancel the growth
+            ePlus = np.exp((s + q) * tau)
+            eMinus = np.exp((s - q) * tau)
+            coshFac = 0.5 * (ePlus + eMinus)
+            sinhFac = 0.5 * (ePlus - eMinus) / q
+        else:
+            eS = np.exp(s * tau)
+            if qSq > 0:
+                coshFac = eS * np.cosh(qTau)
+                sinhFac = eS * (np.sinh(qTau) / q if q > 0 else tau)
+            elif qSq < 0:
+                coshFac = eS * np.cos(qTau)
+                sinhFac = eS * np.sin(qTau) / q
+            else:
+                coshFac = eS
+                sinhFac = eS * tau
+        yMat[0, i] = coshFac * y0[0] + sinhFac * w0
+        yMat[1, i] = coshFac * y0[1] + sinhFac * w1
+    return yMat